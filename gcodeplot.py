@@ -8,10 +8,13 @@ import xml.etree.ElementTree as ET
 import gcodeplotutils.anneal as anneal
 import svgpath.parser as parser
 import cmath
+from array import array
 from random import sample
-from svgpath.shader import Shader
+from svgpath.shader import Shader, HatchCache, Outline
+from svgpath.raster import RasterImage
 from gcodeplotutils.processoffset import OffsetProcessor
 from gcodeplotutils.evaluate import evaluate
+from gcodeplotutils.planner import Planner
 
 SCALE_NONE = 0
 SCALE_DOWN_ONLY = 1
@@ -26,6 +29,7 @@ ALIGN_CENTER = 3
 class Plotter(object):
     def __init__(self, xyMin=(7,8), xyMax=(204,178),
             drawSpeed=35, moveSpeed=40, zSpeed=5, workZ = 14.5, liftDeltaZ = 2.5, safeDeltaZ = 20,
+            acceleration=500., junctionDeviation=0.05,
             liftCommand=None, safeLiftCommand=None, downCommand=None, comment=";",
             initCode = "G00 S1; endstops|"
                        "G00 E0; no extrusion|"
@@ -46,6 +50,8 @@ class Plotter(object):
         self.liftDeltaZ = liftDeltaZ
         self.safeDeltaZ = safeDeltaZ
         self.zSpeed = zSpeed
+        self.acceleration = acceleration
+        self.junctionDeviation = junctionDeviation
         self.liftCommand = liftCommand
         self.safeLiftCommand = safeLiftCommand
         self.downCommand = downCommand
@@ -72,19 +78,19 @@ class Plotter(object):
             'bottom':self.xyMin[1], 'zspeed':self.zSpeed, 'movespeed':self.moveSpeed}
         self.formulas = {'right':str(self.xyMax[0]), 'top':str(self.xyMax[1]), 'up':'work+lift', 'park':'work+safe', 'centerx':'(left+right)/2.', 'centery':'(top+bottom)/2.'}
 
-def processCode(code):
+CODE_EXPRESSION_RE = re.compile(r'\{\{([^}]+)\}\}')
+
+def compileCode(code, variables, formulas):
+    """Returns the commands for code, with its {{expressions}} worked out from variables and formulas"""
     if not code:
         return []
 
-    data = []
-    pattern = r'\{\{([^}]+)\}\}'
-    
-    data = tuple( evaluate(expr, plotter.variables, plotter.formulas) for expr in re.findall(pattern, code))
+    data = tuple( evaluate(expr, variables, formulas) for expr in CODE_EXPRESSION_RE.findall(code))
 
-        
-    formatString = re.sub(pattern, '', code.replace('|', '\n'))
-    
-    return [formatString % data]
+    return [CODE_EXPRESSION_RE.sub('', code.replace('|', '\n')) % data]
+
+def processCode(code):
+    return compileCode(code, plotter.variables, plotter.formulas)
         
 def gcodeHeader(plotter):
     return processCode(plotter.initCode)
@@ -284,6 +290,69 @@ def removePenBob(data):
 
     return outData
 
+def clipLine(a, b, xyMin, xyMax):
+    """
+    Liang-Barsky clipping of the line from a to b to the box from xyMin to xyMax.
+    Returns the clipped endpoints, with unclipped ones returned as is, or None if nothing is left.
+    """
+    t0 = 0.
+    t1 = 1.
+    dx = b[0]-a[0]
+    dy = b[1]-a[1]
+    for p,q in ((-dx, a[0]-xyMin[0]), (dx, xyMax[0]-a[0]), (-dy, a[1]-xyMin[1]), (dy, xyMax[1]-a[1])):
+        if p == 0:
+            if q < 0:
+                return None
+        else:
+            t = q / float(p)
+            if p < 0:
+                if t > t1:
+                    return None
+                t0 = max(t0, t)
+            else:
+                if t < t0:
+                    return None
+                t1 = min(t1, t)
+    return (a if t0 == 0 else (a[0]+t0*dx, a[1]+t0*dy)), (b if t1 == 1 else (a[0]+t1*dx, a[1]+t1*dy))
+
+def clipToArea(data, xyMin, xyMax):
+    """
+    Clip segments to the box from xyMin to xyMax, splitting them where they leave it
+    """
+
+    outData = {}
+
+    for pen in data:
+        outSegments = []
+
+        for segment in data[pen]:
+            xs = [point[0] for point in segment]
+            ys = [point[1] for point in segment]
+            if min(xs) > xyMax[0] or max(xs) < xyMin[0] or min(ys) > xyMax[1] or max(ys) < xyMin[1]:
+                continue
+            if min(xs) >= xyMin[0] and max(xs) <= xyMax[0] and min(ys) >= xyMin[1] and max(ys) <= xyMax[1]:
+                outSegments.append(segment)
+                continue
+
+            outSegment = None
+            for i in range(1,len(segment)):
+                clipped = clipLine(segment[i-1], segment[i], xyMin, xyMax)
+                if clipped is None:
+                    outSegment = None
+                    continue
+                start,end = clipped
+                if outSegment is None or start is not segment[i-1]:
+                    outSegment = [start]
+                    outSegments.append(outSegment)
+                outSegment.append(end)
+                if end is not segment[i]:
+                    outSegment = None
+
+        if outSegments:
+            outData[pen] = outSegments
+
+    return outData
+
 def dedup(data):
     curPoint = None
 
@@ -328,26 +397,114 @@ def penColor(pens, pen):
     else:
         return (0.,0.,0.)
 
-def emitGcode(data, pens = {}, plotter=Plotter(), scalingMode=SCALE_NONE, align = None, tolerance=0, gcodePause="@pause", pauseAtStart = False, simulation = False, relCode = False, incHoming = True):
-    if len(data) == 0:
-        return None
+# arcs flatter than this (in millimeters) are left as lines
+ARC_MAX_RADIUS = 1000.
+
+def fitArcs(points, tolerance):
+    """
+    Splits a polyline into lines and circular arcs that pass within tolerance of its points and of the middles
+    of its lines. Returns (point, center, clockwise) moves to points[1:], with center None for a line.
+    An arc replaces at least three lines and turns less than a full circle.
+    """
+    z = [complex(point[0], point[1]) for point in points]
+
+    def fit(i, j):
+        """Returns the center and direction of an arc through points i to j, if there is one"""
+        a = z[i]
+        ab = z[(i+j)//2] - a
+        ac = z[j] - a
+        d = 2. * (ab.real*ac.imag - ab.imag*ac.real)
+        if d == 0:
+            return None
+        center = a + complex(ac.imag*abs(ab)**2 - ab.imag*abs(ac)**2, ab.real*abs(ac)**2 - ac.real*abs(ab)**2) / d
+        r = abs(a - center)
+        if r > ARC_MAX_RADIUS:
+            return None
+        clockwise = d < 0
+        sweep = 0.
+        for k in range(i, j):
+            if abs(abs(z[k+1] - center) - r) > tolerance or abs(abs((z[k] + z[k+1]) / 2. - center) - r) > tolerance:
+                return None
+            turn = cmath.phase((z[k+1] - center) / (z[k] - center))
+            if (turn < 0) != clockwise or abs(turn) > math.pi / 2:
+                return None
+            sweep += abs(turn)
+        if sweep > 1.9 * math.pi:
+            return None
+        return center, clockwise
+
+    moves = []
+    i = 0
+    while i < len(z) - 1:
+        # gallop to find an end that does not fit, then search for the farthest one that does
+        found = None
+        good = i + 2
+        bad = len(z)
+        end = i + 3
+        while end < bad:
+            arc = fit(i, end)
+            if arc is None:
+                bad = end
+                break
+            found = (end, arc)
+            good = end
+            end = min(i + 2 * (end - i), len(z) - 1) if end < len(z) - 1 else len(z)
+        while bad - good > 1:
+            end = (good + bad) // 2
+            arc = fit(i, end)
+            if arc is None:
+                bad = end
+            else:
+                found = (end, arc)
+                good = end
+        if found is None:
+            moves.append((points[i+1], None, False))
+            i += 1
+        else:
+            end,(center,clockwise) = found
+            moves.append((points[end], (center.real, center.imag), clockwise))
+            i = end
+    return moves
 
+def drawingBounds(data):
+    """
+    Returns the lower left and upper right corners of the box containing all the segments, as lists. Each
+    segment's box comes from the built-in min and max over its coordinates, so only the segments are looped
+    over in Python.
+    """
     xyMin = [float("inf"),float("inf")]
     xyMax = [float("-inf"),float("-inf")]
+    for pen in data:
+        for segment in data[pen]:
+            if segment:
+                xs,ys = zip(*segment)
+                xyMin = [min(xyMin[0], min(xs)), min(xyMin[1], min(ys))]
+                xyMax = [max(xyMax[0], max(xs)), max(xyMax[1], max(ys))]
+    return xyMin, xyMax
 
-    allFit = True
+def emitGcode(data, pens = {}, plotter=Plotter(), scalingMode=SCALE_NONE, align = None, tolerance=0, gcodePause="@pause", pauseAtStart = False, simulation = False, relCode = False, incHoming = True, arcs = False,
+        compact = False, metadata = True, lightSimulation = False, simulationArrows = False, preview = None):
+    """
+    Checks the drawing fits and estimates the printing time, then returns an iterator that formats the
+    commands as they are asked for (or None if there is nothing to print).
+    With arcs, runs of points on a circle within tolerance are drawn with G2/G3.
+    With compact, moves leave out the feed rate and coordinates the machine already has, and comments;
+    with metadata as well, the !! comments that sendgcode evaluates at pauses are kept.
+    With simulation and lightSimulation, runs of moves of the same kind are drawn as one polyline styled
+    by class, with arrowheads at their ends if simulationArrows is set.
+    With simulation and a gcodeplotutils.preview.Preview, the moves are drawn on the preview instead, and the
+    iterator only has to be run through.
+    """
+    if len(data) == 0:
+        return None
+
+    xyMin,xyMax = drawingBounds(data)
 
     scale = Scale()
     scale.offset = (plotter.xyMin[0],plotter.xyMin[1])
 
-    for pen in data:
-        for segment in data[pen]:
-            for point in segment:
-                if not plotter.inRange(scale.scalePoint(point)):
-                    allFit = False
-                for i in range(2):
-                    xyMin[i] = min(xyMin[i], point[i])
-                    xyMax[i] = max(xyMax[i], point[i])
+    # the drawing fits when the corners of its box do
+    allFit = xyMin[0] > xyMax[0] or (plotter.inRange(scale.scalePoint(xyMin)) and plotter.inRange(scale.scalePoint(xyMax)))
 
     if scalingMode == SCALE_NONE:
         if not allFit:
@@ -362,148 +519,312 @@ def emitGcode(data, pens = {}, plotter=Plotter(), scalingMode=SCALE_NONE, align
     if align is not None:
         scale.align(plotter, xyMin, xyMax, align)
 
-    if not simulation:
-        gcode = gcodeHeader(plotter)
-    else:
+    # the plotter's code is worked out once, from the variables as they are now, as lift and down
+    # commands are run at every move
+    variables = dict(plotter.variables)
+    formulas = dict(plotter.formulas)
+    initCode,endCode,liftCommand,safeLiftCommand,downCommand = [compileCode(code, variables, formulas) for code in
+        (plotter.initCode, plotter.endCode, plotter.liftCommand, plotter.safeLiftCommand, plotter.downCommand)]
+
+    def commands(emit):
+        """
+        Goes through the drawing, yielding the commands if emit is set; otherwise just replays the moves
+        into state.planner, without formatting anything
+        """
         gcode = []
-        gcode.append('<?xml version="1.0" standalone="yes"?>')
-        gcode.append('<svg width="%.4fmm" height="%.4fmm" viewBox="%.4f %.4f %.4f %.4f" xmlns="http://www.w3.org/2000/svg" version="1.1">' % (
-            plotter.xyMax[0]-plotter.xyMin[0], plotter.xyMax[1]-plotter.xyMin[0], plotter.xyMin[0], plotter.xyMin[1], plotter.xyMax[0], plotter.xyMax[1]))
+        # feed rate and coordinates as last sent, for compact output
+        modal = {}
+
+        def compactMove(g, feed, axes, substitutions=(), relative=False):
+            """
+            Formats a move for compact output, with the (letter, value) axes that change; substitutions
+            are the !! expressions for those axes
+            """
+            words = []
+            for letter,value in axes:
+                text = '%.3f' % value
+                if letter in 'IJ':
+                    words.append(letter + text)
+                elif relative and letter in 'XY':
+                    if float(text) != 0:
+                        words.append(letter + text)
+                elif modal.get(letter) != text:
+                    words.append(letter + text)
+                    modal[letter] = text
+            if not words:
+                return
+            text = '%.1f' % feed
+            if modal.get('F') != text:
+                words.insert(0, 'F' + text)
+                modal['F'] = text
+            command = 'G%d %s' % (g, ' '.join(words))
+            substitutions = [s for s in substitutions if any(word[0] == s[0] for word in words)]
+            if metadata and substitutions:
+                command += ';!!' + ' '.join(substitutions)
+            gcode.append(command)
+
+        def custom(code):
+            # user code can leave the machine anywhere
+            gcode.extend(code)
+            modal.clear()
+
+        def mode(command, comment):
+            gcode.append(command if compact else command + comment)
+
+        if not simulation:
+            gcode += initCode
+        elif preview is None:
+            gcode.append('<?xml version="1.0" standalone="yes"?>')
+            gcode.append('<svg width="%.4fmm" height="%.4fmm" viewBox="%.4f %.4f %.4f %.4f" xmlns="http://www.w3.org/2000/svg" version="1.1">' % (
+                plotter.xyMax[0]-plotter.xyMin[0], plotter.xyMax[1]-plotter.xyMin[0], plotter.xyMin[0], plotter.xyMin[1], plotter.xyMax[0], plotter.xyMax[1]))
+            if lightSimulation:
+                if simulationArrows:
+                    gcode.append('<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="10" markerHeight="10" orient="auto">'
+                        '<path d="M0,0 L10,5 L0,10" fill="none" stroke="rgb(0,128,0)"/></marker></defs>')
+                style = ['polyline{fill:none;stroke-linejoin:round%s}' % (';marker-end:url(#arrow)' if simulationArrows else ''),
+                    '.m{stroke:rgb(0,128,0);stroke-width:0.1}', '.d{stroke-width:0.15}']
+                for pen in sorted(data):
+                    color = [int(math.floor(255*x+0.5)) for x in penColor(pens, pen)]
+                    style.append('.p%d{stroke:rgb(%d,%d,%d)}' % (pen, color[0], color[1], color[2]))
+                gcode.append('<style>%s</style>' % ''.join(style))
             
             
-    def park():
-        if not simulation:
-            lift = plotter.safeLiftCommand or plotter.liftCommand
-            if lift:
-                gcode.extend(processCode(lift))
-            else:
-                if relCode:
-                    gcode.append('G90 ;Absolute mode for Z movement')
-                gcode.append('G00 F%.1f Z%.3f; pen park !!Zpark' % (plotter.zSpeed*60., plotter.safeUpZ))
-                if relCode:
-                    gcode.append('G91 ;Relative mode for XY movement')
-
-    park()
-    if relCode:
-        gcode.append('G91 ;Relative mode for XY movement')
-    if not simulation:
-        gcode.append('G00 F%.1f Y%.3f; !!Ybottom' % (plotter.moveSpeed*60.,   plotter.xyMin[1]))
-        gcode.append('G00 F%.1f X%.3f; !!Xleft' % (plotter.moveSpeed*60.,   plotter.xyMin[0]))
-
-    class State(object):
-        pass
-
-    state = State()
-    state.time = (plotter.xyMin[1]+plotter.xyMin[0]) / plotter.moveSpeed
-    state.curXY = plotter.xyMin
-    state.curZ = plotter.safeUpZ
-    state.penColor = (0.,0.,0.)
-
-    def distance(a,b):
-        return math.hypot(a[0]-b[0],a[1]-b[1])
-
-    def penUp(force=False):
-        if state.curZ is None or state.curZ not in (plotter.safeUpZ, plotter.penUpZ) or force:
+        def park():
             if not simulation:
-                if plotter.liftCommand:
-                    gcode.extend(processCode(plotter.liftCommand))
+                lift = safeLiftCommand or liftCommand
+                if lift:
+                    custom(lift)
                 else:
-                    gcode.append('G00 F%.1f Z%.3f; pen up !!Zup' % (plotter.zSpeed*60., plotter.penUpZ))
-            if state.curZ is not None:
-                state.time += abs(plotter.penUpZ-state.curZ) / plotter.zSpeed
-            state.curZ = plotter.penUpZ
+                    if relCode:
+                        mode('G90', ' ;Absolute mode for Z movement')
+                    if compact:
+                        compactMove(0, plotter.zSpeed*60., [('Z', plotter.safeUpZ)], ['Zpark'])
+                    else:
+                        gcode.append('G00 F%.1f Z%.3f; pen park !!Zpark' % (plotter.zSpeed*60., plotter.safeUpZ))
+                    if relCode:
+                        mode('G91', ' ;Relative mode for XY movement')
 
-    def penDown(force=False):
-        if state.curZ is None or state.curZ != plotter.workZ or force:
-            if not simulation:
-                if plotter.downCommand:
-                    gcode.extend(processCode(plotter.downCommand))
+        park()
+        if relCode:
+            mode('G91', ' ;Relative mode for XY movement')
+        if not simulation:
+            if compact:
+                compactMove(0, plotter.moveSpeed*60., [('Y', plotter.xyMin[1])], ['Ybottom'], relative=relCode)
+                compactMove(0, plotter.moveSpeed*60., [('X', plotter.xyMin[0])], ['Xleft'], relative=relCode)
+            else:
+                gcode.append('G00 F%.1f Y%.3f; !!Ybottom' % (plotter.moveSpeed*60.,   plotter.xyMin[1]))
+                gcode.append('G00 F%.1f X%.3f; !!Xleft' % (plotter.moveSpeed*60.,   plotter.xyMin[0]))
+
+        state.planner = None if emit else Planner(plotter.acceleration, plotter.junctionDeviation, (0., 0., plotter.safeUpZ))
+        if state.planner:
+            # the way to the start counts towards the first pen
+            state.planner.setGroup(min(data) if data else 0)
+            state.planner.moveTo(0., plotter.xyMin[1], plotter.safeUpZ, plotter.moveSpeed)
+            state.planner.moveTo(plotter.xyMin[0], plotter.xyMin[1], plotter.safeUpZ, plotter.moveSpeed)
+        state.curXY = plotter.xyMin
+        state.curZ = plotter.safeUpZ
+        state.penColor = (0.,0.,0.)
+        state.pen = None
+        # class and last point of the polyline being drawn, for lightSimulation
+        state.polyline = None
+
+        def distance(a,b):
+            return math.hypot(a[0]-b[0],a[1]-b[1])
+
+        def plan(x=None, y=None, z=None, speed=None):
+            """Replays a move into the planner, or just sets the axes if speed is None"""
+            if state.planner:
+                if speed is None:
+                    state.planner.setPosition(x, y, z)
                 else:
+                    position = state.planner.position
+                    state.planner.moveTo(position[0] if x is None else x, position[1] if y is None else y,
+                        position[2] if z is None else z, speed)
+
+        def penUp(force=False):
+            if state.curZ is None or state.curZ not in (plotter.safeUpZ, plotter.penUpZ) or force:
+                if not simulation and emit:
+                    if liftCommand:
+                        custom(liftCommand)
+                    elif compact:
+                        compactMove(0, plotter.zSpeed*60., [('Z', plotter.penUpZ)], ['Zup'])
+                    else:
+                        gcode.append('G00 F%.1f Z%.3f; pen up !!Zup' % (plotter.zSpeed*60., plotter.penUpZ))
+                plan(z=plotter.penUpZ, speed=None if state.curZ is None else plotter.zSpeed)
+                state.curZ = plotter.penUpZ
+
+        def penDown(force=False):
+            if state.curZ is None or state.curZ != plotter.workZ or force:
+                if not simulation and emit:
+                    if downCommand:
+                        custom(downCommand)
+                    else:
+                        if relCode:
+                            mode('G90', ' ;Absolute mode for Z movement')
+                        if compact:
+                            compactMove(0, plotter.zSpeed*60., [('Z', plotter.workZ)], ['Zwork'])
+                        else:
+                            gcode.append('G00 F%.1f Z%.3f; pen down !!Zwork' % (plotter.zSpeed*60., plotter.workZ))
+                        if relCode:
+                            mode('G91', ' ;Relavite mode for XY-movement')
+                plan(z=plotter.workZ, speed=None if state.curZ is None else plotter.zSpeed)
+                state.curZ = plotter.workZ
+
+        def penMove(down, speed, p, force=False):
+            def flip(y):
+                return plotter.xyMax[1] - (y-plotter.xyMin[1])
+            if state.curXY is None:
+                d = float("inf")
+            else:
+                d = distance(state.curXY, p)
+            if d > tolerance or force:
+                if down:
+                    penDown(force=force)
+                else:
+                    penUp(force=force)
+                if not emit:
+                    pass
+                elif not simulation:
+                    x = p[0]
+                    y = p[1]
                     if relCode:
-                        gcode.append('G90 ;Absolute mode for Z movement')
-                    gcode.append('G00 F%.1f Z%.3f; pen down !!Zwork' % (plotter.zSpeed*60., plotter.workZ))
-                    if relCode:
-                        gcode.append('G91 ;Relavite mode for XY-movement')
-            state.time += abs(state.curZ-plotter.workZ) / plotter.zSpeed
-            state.curZ = plotter.workZ
-
-    def penMove(down, speed, p, force=False):
-        def flip(y):
-            return plotter.xyMax[1] - (y-plotter.xyMin[1])
-        if state.curXY is None:
-            d = float("inf")
-        else:
-            d = distance(state.curXY, p)
-        if d > tolerance or force:
-            if down:
-                penDown(force=force)
+                        x -= state.curXY[0]
+                        y -= state.curXY[1]
+                    if compact:
+                        compactMove(1 if down else 0, speed*60., [('X', x), ('Y', y)],
+                            ['Xleft+%.3f' % (p[0]-plotter.xyMin[0]), 'Ybottom+%.3f' % (p[1]-plotter.xyMin[1])], relative=relCode)
+                    else:
+                        gcode.append('G0%d F%.1f X%.3f Y%.3f; %s !!Xleft+%.3f Ybottom+%.3f' % (
+                            1 if down else 0, speed*60., x, y, "draw" if down else "move",
+                            p[0]-plotter.xyMin[0], p[1]-plotter.xyMin[1]))
+                elif preview is not None:
+                    start = state.curXY if state.curXY is not None else plotter.xyMin
+                    if down:
+                        preview.line(start, p, state.penColor)
+                    else:
+                        preview.travel(start, p)
+                elif lightSimulation:
+                    start = state.curXY if state.curXY is not None else plotter.xyMin
+                    kind = 'd p%d' % state.pen if down else 'm'
+                    if state.polyline is None or state.polyline[0] != kind or state.polyline[1] != start:
+                        if state.polyline is not None:
+                            gcode.append('"/>')
+                        # one point a line, so the polyline can be written out before it is finished
+                        gcode.append('<polyline class="%s" points="%.2f,%.2f' % (kind, start[0], flip(start[1])))
+                    gcode.append('%.2f,%.2f' % (p[0], flip(p[1])))
+                    state.polyline = (kind, p)
+                else:
+                    start = state.curXY if state.curXY is not None else plotter.xyMin
+                    color = [int(math.floor(255*x+0.5)) for x in (state.penColor if down else (0,0.5,0))]
+                    thickness = 0.15 if down else 0.1
+                    end = complex(p[0], flip(p[1]))
+                    gcode.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="rgb(%d,%d,%d)" stroke-width="%.2f"/>'
+                        % (start[0], flip(start[1]), end.real, end.imag, color[0], color[1], color[2], thickness))
+                    ray = end - complex(start[0],flip(start[1]))
+                    if abs(ray)>0:
+                        ray = ray/abs(ray)
+                        for theta in [math.pi * 0.8,-math.pi * 0.8]:
+                            head = end + ray * cmath.rect(max(0.3,min(2,d*0.25)), theta)
+                            gcode.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="rgb(0,128,0)" stroke-linejoin="round" stroke-width="0.1"/>'
+                                % (end.real, end.imag, head.real, head.imag))
+
+                plan(x=p[0], y=p[1], speed=None if state.curXY is None else speed)
+                state.curXY = p
+
+        def penArc(speed, p, center, clockwise):
+            penDown()
+            x = p[0]
+            y = p[1]
+            if relCode:
+                x -= state.curXY[0]
+                y -= state.curXY[1]
+            if compact:
+                compactMove(2 if clockwise else 3, speed*60., [('X', x), ('Y', y), ('I', center[0]-state.curXY[0]), ('J', center[1]-state.curXY[1])],
+                    ['Xleft+%.3f' % (p[0]-plotter.xyMin[0]), 'Ybottom+%.3f' % (p[1]-plotter.xyMin[1])], relative=relCode)
             else:
-                penUp(force=force)
-            if not simulation:
-                x = p[0]
-                y = p[1]
-                if relCode:
-                    x -= state.curXY[0]
-                    y -= state.curXY[1]
-                gcode.append('G0%d F%.1f X%.3f Y%.3f; %s !!Xleft+%.3f Ybottom+%.3f' % (
-                    1 if down else 0, speed*60., x, y, "draw" if down else "move",
+                gcode.append('G0%d F%.1f X%.3f Y%.3f I%.3f J%.3f; draw arc !!Xleft+%.3f Ybottom+%.3f' % (
+                    2 if clockwise else 3, speed*60., x, y, center[0]-state.curXY[0], center[1]-state.curXY[1],
                     p[0]-plotter.xyMin[0], p[1]-plotter.xyMin[1]))
-            else:
-                start = state.curXY if state.curXY is not None else plotter.xyMin
-                color = [int(math.floor(255*x+0.5)) for x in (state.penColor if down else (0,0.5,0))]
-                thickness = 0.15 if down else 0.1
-                end = complex(p[0], flip(p[1]))
-                gcode.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="rgb(%d,%d,%d)" stroke-width="%.2f"/>'
-                    % (start[0], flip(start[1]), end.real, end.imag, color[0], color[1], color[2], thickness))
-                ray = end - complex(start[0],flip(start[1]))
-                if abs(ray)>0:
-                    ray = ray/abs(ray)
-                    for theta in [math.pi * 0.8,-math.pi * 0.8]:
-                        head = end + ray * cmath.rect(max(0.3,min(2,d*0.25)), theta)
-                        gcode.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="rgb(0,128,0)" stroke-linejoin="round" stroke-width="0.1"/>'
-                            % (end.real, end.imag, head.real, head.imag))
-
-            if state.curXY is not None:
-                state.time += d / speed
             state.curXY = p
 
-    for pen in sorted(data):
-        if pen != 1:
-            state.curZ = None
-            state.curXY = None
-
-        state.penColor = penColor(pens, pen)
-
-        s = scale.clone()
-
-        if pens is not None and pen in pens:
-            s.offset = (s.offset[0]-pens[pen].offset[0],s.offset[1]-pens[pen].offset[1])
+        for pen in sorted(data):
+            if pen != 1:
+                state.curZ = None
+                state.curXY = None
+            if state.planner:
+                state.planner.setGroup(pen)
+
+            state.penColor = penColor(pens, pen)
+            state.pen = pen
+
+            s = scale.clone()
+
+            if pens is not None and pen in pens:
+                s.offset = (s.offset[0]-pens[pen].offset[0],s.offset[1]-pens[pen].offset[1])
+
+            newPen = True
+
+            for segment in data[pen]:
+                penMove(False, plotter.moveSpeed, s.scalePoint(segment[0]))
+
+                if newPen and (pen != 1 or pauseAtStart) and not simulation:
+                    gcode.append( gcodePause+' load pen: ' + describePen(pens,pen) )
+                    # anything can be changed during the pause
+                    modal.clear()
+                    if state.planner:
+                        state.planner.stop()
+                    penMove(False, plotter.moveSpeed, s.scalePoint(segment[0]), force=True)
+                newPen = False
+
+                if arcs and emit and not simulation:
+                    # the estimate, from the lines, is within the tolerance of the arcs
+                    for p,center,clockwise in fitArcs([s.scalePoint(point) for point in segment], tolerance):
+                        if center is None:
+                            penMove(True, plotter.drawSpeed, p)
+                        else:
+                            penArc(plotter.drawSpeed, p, center, clockwise)
+                else:
+                    for i in range(1,len(segment)):
+                        penMove(True, plotter.drawSpeed, s.scalePoint(segment[i]))
 
-        newPen = True
+                # hand over what this segment made, so only one segment's commands are held at a time
+                if emit:
+                    for command in gcode:
+                        yield command
+                del gcode[:]
 
-        for segment in data[pen]:
-            penMove(False, plotter.moveSpeed, s.scalePoint(segment[0]))
+        park()
 
-            if newPen and (pen != 1 or pauseAtStart) and not simulation:
-                gcode.append( gcodePause+' load pen: ' + describePen(pens,pen) )
-                penMove(False, plotter.moveSpeed, s.scalePoint(segment[0]), force=True)
-            newPen = False
+        if simulation and preview is None:
+            if state.polyline is not None:
+                gcode.append('"/>')
+            gcode.append('</svg>')
+        elif not simulation:
+            custom(endCode)
 
-            for i in range(1,len(segment)):
-                penMove(True, plotter.drawSpeed, s.scalePoint(segment[i]))
+        if emit:
+            for command in gcode:
+                yield command
 
-    park()
+    class State(object):
+        pass
 
-    if simulation:
-        gcode.append('</svg>')
-    else:
-        gcode.extend(processCode(plotter.endCode))
+    state = State()
 
+    # the estimate comes from a pass that formats nothing, so it is known before any output; it is only
+    # written out when not quiet, so the pass is left out otherwise
     if not quiet:
-        sys.stderr.write('Estimated printing time: %dm %.1fs\n' % (state.time // 60, state.time % 60))
+        for command in commands(False):
+            pass
+        times = state.planner.times()
+        if len(times) > 1:
+            for pen in sorted(times):
+                sys.stderr.write('Estimated time for pen %d: %dm %.1fs\n' % (pen, times[pen] // 60, times[pen] % 60))
+        total = sum(times.values())
+        sys.stderr.write('Estimated printing time: %dm %.1fs\n' % (total // 60, total % 60))
         sys.stderr.flush()
 
-    return gcode
+    return commands(True)
 
 def parseHPGL(hpgl,dpi=(1016.,1016.)):
     try:
@@ -591,42 +912,188 @@ def getPen(pens, color):
 
     return bestPen
 
-def parseSVG(svgTree, tolerance=0.05, shader=None, strokeAll=False, pens=None, extractColor = None):
-    data = {}
-    for path in parser.getPathsFromSVG(svgTree)[0]:
-        lines = []
+class Occlusion(object):
+    """
+    The opaque fills of a drawing, flattened and put in a grid by bounding box, to quickly find
+    the fills painted over a path. The flattened lines and outline of each fill are kept until
+    takeFlattened() hands them on to flattenPath().
+    """
+    def __init__(self, paths, tolerance=0.05):
+        self.fills = []
+        self.flattened = {}
+        for index,path in enumerate(paths):
+            state = path.svgState
+            if state.fill is not None and (state.fillOpacity is None or state.fillOpacity >= 1.):
+                mode = Shader.MODE_NONZERO if state.fillRule == 'nonzero' else Shader.MODE_EVEN_ODD
+                lines = [(line.start, line.end) for line in path.linearApproximation(error=tolerance)]
+                polygon = Outline(lines).lines
+                self.flattened[index] = (lines, polygon)
+                if polygon:
+                    xs = [z.real for line in polygon for z in line]
+                    ys = [z.imag for line in polygon for z in line]
+                    self.fills.append((index, polygon, mode, (min(xs),min(ys)), (max(xs),max(ys))))
+
+        # cells about the size of the average fill
+        self.cellSize = max(1e-6, sum(max(fill[4][0]-fill[3][0], fill[4][1]-fill[3][1]) for fill in self.fills) / max(1, len(self.fills)))
+        self.grid = {}
+        for i,fill in enumerate(self.fills):
+            for cell in self.cells(fill[3], fill[4]):
+                self.grid.setdefault(cell, []).append(i)
+
+    def cells(self, xyMin, xyMax):
+        x0,y0,x1,y1 = (int(math.floor(c / self.cellSize)) for c in (xyMin[0], xyMin[1], xyMax[0], xyMax[1]))
+        return ((x,y) for x in range(x0,x1+1) for y in range(y0,y1+1))
+
+    def occluders(self, index, xyMin, xyMax):
+        """
+        Returns (polygon, mode) pairs for the opaque fills painted after paths[index] whose boxes meet the given one
+        """
+        found = set()
+        for cell in self.cells(xyMin, xyMax):
+            for i in self.grid.get(cell, ()):
+                fill = self.fills[i]
+                if fill[0] > index and fill[3][0] <= xyMax[0] and fill[4][0] >= xyMin[0] and fill[3][1] <= xyMax[1] and fill[4][1] >= xyMin[1]:
+                    found.add(i)
+        return [(self.fills[i][1], self.fills[i][2]) for i in sorted(found)]
+
+    def takeFlattened(self, index):
+        """Returns and forgets the (lines, outline) of paths[index] if it is a fill, or None"""
+        return self.flattened.pop(index, None)
+
+    def occludersOf(self, index, path):
+        if path.svgState.fill is None:
+            return None
+        lowerLeft,upperRight = path.bbox()
+        return self.occluders(index, (lowerLeft.real,lowerLeft.imag), (upperRight.real,upperRight.imag))
+
+def flattenPath(path, tolerance=0.05, shader=None, strokeAll=False, pens=None, extractColor=None, occluders=None, flattened=None):
+    """
+    Flattens and shades a single path. Returns a list of (pen, lines) pairs in drawing order,
+    where lines is a compact array('d') of x1,y1,x2,y2 values that can be sent between processes.
+    The shading leaves out the (polygon, mode) occluders. flattened is the (lines, outline) of the
+    path if Occlusion has already worked them out.
+    A RasterImage is hatched by its gray levels, with the pen for black.
+    """
+    if isinstance(path, RasterImage):
+        if shader is None or not shader.isActive() or (extractColor is not None and not isSameColor((0.,0.,0.), extractColor)):
+            return []
+        try:
+            fillLines = shader.shadeImage(path)
+        except ValueError as e:
+            sys.stderr.write("Skipping image: %s\n" % e)
+            return []
+        return [(getPen(pens, (0.,0.,0.)), array('d', (c for line in fillLines for c in (line[0].real,line[0].imag,line[1].real,line[1].imag))))]
+
+    out = []
 
-        stroke = strokeAll or (path.svgState.stroke is not None and (extractColor is None or isSameColor(path.svgState.stroke, extractColor)))
+    stroke = strokeAll or (path.svgState.stroke is not None and (extractColor is None or isSameColor(path.svgState.stroke, extractColor)))
 
-        strokePen = getPen(pens, path.svgState.stroke)
+    strokePen = getPen(pens, path.svgState.stroke)
+    strokeLines = array('d')
 
-        if strokePen not in data:
-            data[strokePen] = []
+    if flattened is None:
+        lines = [(line.start, line.end) for line in path.linearApproximation(error=tolerance)]
+        outline = None
+    else:
+        lines,outline = flattened
+    if stroke:
+        for start,end in lines:
+            strokeLines.extend((start.real,start.imag,end.real,end.imag))
+    out.append((strokePen, strokeLines))
+
+    if shader is not None and shader.isActive() and path.svgState.fill is not None and (extractColor is None or
+            isSameColor(path.svgState.fill, extractColor)):
+        pen = getPen(pens, path.svgState.fill)
+
+        grayscale = sum(path.svgState.fill) / 3.
+        mode = Shader.MODE_NONZERO if path.svgState.fillRule == 'nonzero' else Shader.MODE_EVEN_ODD
+        if path.svgState.fillOpacity is not None:
+            grayscale = grayscale * path.svgState.fillOpacity + 1. - path.svgState.fillOpacity # TODO: real alpha!
+        fillLines = shader.shade(Outline(lines).lines if outline is None else outline, grayscale, avoidOutline=(path.svgState.stroke is None or strokePen != pen), mode=mode, occluders=occluders)
+        out.append((pen, array('d', (c for line in fillLines for c in (line[0].real,line[0].imag,line[1].real,line[1].imag)))))
 
-        for line in path.linearApproximation(error=tolerance):
-            if stroke:
-                data[strokePen].append([(line.start.real,line.start.imag),(line.end.real,line.end.imag)])
-            lines.append((line.start, line.end))
-        if not data[strokePen]:
-            del data[strokePen]
+    return out
 
-        if shader is not None and shader.isActive() and path.svgState.fill is not None and (extractColor is None or
-                isSameColor(path.svgState.fill, extractColor)):
-            pen = getPen(pens, path.svgState.fill)
+def visiblePaths(paths, clipArea=None):
+    """
+    Drop paths whose bounding boxes are outside clipArea, an (xyMin, xyMax) pair
+    """
+    if clipArea is None:
+        return paths
+    xyMin,xyMax = clipArea
+    out = []
+    for path in paths:
+        lowerLeft,upperRight = path.bbox()
+        if lowerLeft.real <= xyMax[0] and upperRight.real >= xyMin[0] and lowerLeft.imag <= xyMax[1] and upperRight.imag >= xyMin[1]:
+            out.append(path)
+    return out
 
-            if pen not in data:
-                data[pen] = []
+_flattenJob = None
 
-            grayscale = sum(path.svgState.fill) / 3.
-            mode = Shader.MODE_NONZERO if path.svgState.fillRule == 'nonzero' else Shader.MODE_EVEN_ODD
-            if path.svgState.fillOpacity is not None:
-                grayscale = grayscale * path.svgState.fillOpacity + 1. - path.svgState.fillOpacity # TODO: real alpha!
-            fillLines = shader.shade(lines, grayscale, avoidOutline=(path.svgState.stroke is None or strokePen != pen), mode=mode)
-            for line in fillLines:
-                data[pen].append([(line[0].real,line[0].imag),(line[1].real,line[1].imag)])
+def _initFlattenWorker(svgTree, clipArea, occlusion, options):
+    global _flattenJob
+    if _flattenJob is None:
+        # not forked from the parent process, so the paths need parsing again
+        paths = visiblePaths(parser.getPathsFromSVG(svgTree, images=options['shader'] is not None and options['shader'].isActive())[0], clipArea)
+        _flattenJob = (paths, Occlusion(paths, options['tolerance']) if occlusion else None, options)
+
+def _flattenChunk(chunk):
+    """
+    Returns the flattened paths and what was added to and used in the hatch cache, for the parent to save in the
+    cache file
+    """
+    paths, occlusion, options = _flattenJob
+    results = [flattenPath(paths[i], occluders=occlusion and occlusion.occludersOf(i, paths[i]), flattened=occlusion and occlusion.takeFlattened(i), **options)
+        for i in range(chunk[0], chunk[1])]
+    shader = options['shader']
+    return results, (shader.cache.takeNew() if shader is not None and shader.cache is not None and shader.cache.filename is not None else None)
+
+def parseSVG(svgTree, tolerance=0.05, shader=None, strokeAll=False, pens=None, extractColor = None, processes=1, clipArea=None, occlusion=False):
+    """
+    processes is the number of processes to flatten and shade paths in (None for one per CPU).
+    If clipArea is an (xyMin, xyMax) pair, paths entirely outside it are skipped; the rest still need clipToArea().
+    With occlusion, shading is left out where opaque fills are painted over it.
+    """
+    global _flattenJob
+
+    paths = visiblePaths(parser.getPathsFromSVG(svgTree, images=shader is not None and shader.isActive())[0], clipArea)
+    options = dict(tolerance=tolerance, shader=shader, strokeAll=strokeAll, pens=pens, extractColor=extractColor)
+    occlusionData = Occlusion(paths, tolerance) if occlusion and shader is not None and shader.isActive() else None
+
+    if processes == 1 or len(paths) < 2:
+        results = (flattenPath(path, occluders=occlusionData and occlusionData.occludersOf(i, path), flattened=occlusionData and occlusionData.takeFlattened(i), **options)
+            for i,path in enumerate(paths))
+    else:
+        import multiprocessing
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        chunkSize = max(1, len(paths) // (4 * processes))
+        chunks = [(i, min(i+chunkSize, len(paths))) for i in range(0, len(paths), chunkSize)]
+        _flattenJob = (paths, occlusionData, options)
+        pool = multiprocessing.Pool(processes, initializer=_initFlattenWorker, initargs=(svgTree, clipArea, occlusionData is not None, options))
+        try:
+            results = []
+            for chunkResults,cacheEntries in pool.imap(_flattenChunk, chunks):
+                results += chunkResults
+                if cacheEntries:
+                    shader.cache.merge(*cacheEntries)
+            pool.close()
+        except:
+            # don't leave the workers going on with the rest of the chunks
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _flattenJob = None
 
-            if not data[pen]:
-                del data[pen]
+    data = {}
+    for result in results:
+        for pen,lines in result:
+            if lines:
+                segments = data.setdefault(pen, [])
+                for i in range(0,len(lines),4):
+                    segments.append([(lines[i],lines[i+1]),(lines[i+2],lines[i+3])])
 
     return data
 
@@ -687,23 +1154,43 @@ def directionalize(paths, angle, tolerance=1e-10):
     return outPaths
 
 def fixComments(plotter, data, comment = ";"):
+    """Returns the commands in data with their comments in the given delimiters, a command at a time"""
     if comment == ";":
         return data
-    out = []
+    return _fixComments(data, comment)
+
+def _fixComments(data, comment):
     for command in data:
         for line in command.split('\n'):
-            try:
-                ind = line.index(";")
-                if ind >= 0:
-                    if not comment:
-                        out.append( line[:ind].strip() )
-                    else:
-                        out.append( line[:ind] + comment[0] + line[ind+1:] + comment[1:] )
+            ind = line.find(";")
+            if ind >= 0:
+                if not comment:
+                    yield line[:ind].strip()
                 else:
-                    out.append(line)
-            except ValueError:
-                out.append(line)
-    return out
+                    yield line[:ind] + comment[0] + line[ind+1:] + comment[1:]
+            else:
+                yield line
+
+def writeLines(lines, stream, batch=4096):
+    """Writes each line followed by a newline, joining them a batch at a time"""
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= batch:
+            buffer.append('')
+            stream.write('\n'.join(buffer))
+            buffer = []
+    if buffer:
+        buffer.append('')
+        stream.write('\n'.join(buffer))
+
+def echoCommands(plotter, data, stream, comment = ";"):
+    """Passes the commands in data through, writing each one to stream on the way as fixComments() would"""
+    for command in data:
+        for line in fixComments(plotter, [command], comment=comment):
+            stream.write(line)
+            stream.write('\n')
+        yield command
 
 if __name__ == '__main__':
 
@@ -720,25 +1207,43 @@ if __name__ == '__main__':
  -f|--scale=mode: scaling option: none(n), fit(f), down-only(d) [default none; other options don't work with tool-offset]
  -D|--input-dpi=xdpi[,ydpi]: hpgl dpi
  -t|--tolerance=x: ignore (some) deviations of x millimeters or less [default 0.05]
+    --arc-fit*: draw runs of points on a circle, within the tolerance, as G2/G3 arcs
+    --compact*: leave out feed rates and coordinates that do not change, and comments (keeping the !! ones when sending)
+    --meatpack*: pack the gcode that is output or sent for firmware with MeatPack support (output is binary)
+    --simulation*: output an SVG of the moves instead of gcode
+    --light-simulation*: output a smaller SVG of the moves, with runs of moves joined into polylines
+    --simulation-arrows*: with --light-simulation, put an arrowhead at the end of each polyline
+    --simulation-png*: output a PNG picture of the moves instead of gcode
+    --simulation-dpi=x: resolution of the --simulation-png picture [default 100]
  -s|--send=port*: send gcode to serial port instead of stdout
  -S|--send-speed=baud: set baud rate for sending
  -x|--align-x=mode: horizontal alignment: none(n), left(l), right(r) or center(c)
  -y|--align-y=mode: vertical alignment: none(n), bottom(b), top(t) or center(c)
  -a|--area=x1,y1,x2,y2: gcode print area in millimeters
+    --clip*: clip the drawing to the print area instead of refusing to plot it (only with --scale=none and no alignment)
  -Z|--lift-delta-z=z: amount to lift for pen-up (millimeters)
  -z|--work-z=z: z-position for drawing (millimeters)
  -F|--pen-up-speed=z: speed for moving with pen up (millimeters/second)
  -f|--pen-down-speed=z: speed for moving with pen down (millimeters/second)
  -u|--z-speed=s: speed for up/down movement (millimeters/second)
+    --acceleration=a: acceleration of the machine for the time estimate (millimeters/second^2; 0 for none) [default 500]
+    --junction-deviation=d: junction deviation of the machine for the time estimate (millimeters) [default 0.05]
  -H|--hpgl-out*: output is HPGL, not gcode; most options ignored [default: off]
  -T|--shading-threshold=n: darkest grayscale to leave unshaded (decimal, 0. to 1.; set to 0 to turn off SVG shading) [default 1.0]
  -m|--shading-lightest=x: shading spacing for lightest colors (millimeters) [default 3.0]
  -M|--shading-darkest=x: shading spacing for darkest color (millimeters) [default 0.5]
  -A|--shading-angle=x: shading angle (degrees) [default 45]
  -X|--shading-crosshatch*: cross hatch shading
+    --shading-layers=n: hatch darker grays with up to n layers at evenly spread angles rather than tighter spacing (not with --shading-crosshatch) [default 1]
+    --shading-contour*: shade with contours parallel to the outline, linked into spirals, instead of hatching
+    --shading-zigzag*: join shading lines into zig-zags along the outline to save pen lifts (not with --direction)
+    --shading-cache=file: keep the shading of shapes in file, to reuse it in this run and later ones; the shapes used longest ago are dropped when it gets large [default none]
+    --shading-backend=b: compute shading with python or numpy (falls back to python if numpy is missing) [default python]
  -L|--stroke-all*: stroke even regions specified by SVG to have no stroke
  -O|--shading-avoid-outline*: avoid going over outline twice when shading
+    --shading-occlusion*: do not shade what opaque fills are painted over
  -o|--optimization-time=t: max time to spend optimizing (seconds; set to 0 to turn off optimization) [default 60]
+    --parallel=n: number of processes for flattening and shading SVG paths (0 = one per CPU) [default 1]
  -e|--direction=angle: for slanted pens: prefer to draw in given direction (degrees; 0=positive x, 90=positive y, none=no preferred direction) [default none]
  -d|--sort*: sort paths from inside to outside for cutting [default off]
  -c|--config-file=filename: read arguments, one per line, from filename
@@ -758,6 +1263,9 @@ if __name__ == '__main__':
 
 
     tolerance = 0.05
+    arcFit = False
+    compact = False
+    meatpack = False
     doDedup = True
     sendPort = None
     sendSpeed = 115200
@@ -778,6 +1286,10 @@ if __name__ == '__main__':
     pauseAtStart = False
     sortPaths = False
     svgSimulation = False
+    lightSimulation = False
+    simulationArrows = False
+    simulationPng = False
+    simulationDpi = 100.
     toolOffset = 0.
     overcut = 0.
     toolMode = "custom"
@@ -788,6 +1300,9 @@ if __name__ == '__main__':
     directionAngle = None
     relCode = False
     incHoming = True
+    processes = 1
+    clip = False
+    occlusion = False
 
     def maybeNone(a):
         return None if a=='none' else a
@@ -796,13 +1311,13 @@ if __name__ == '__main__':
         opts, args = getopt.getopt(sys.argv[1:], "e:UR:Uhdulw:P:o:Oc:LT:M:m:A:XHrf:na:D:t:s:S:x:y:z:Z:p:f:F:",
                         ["help", "down", "up", "lower-left", "allow-repeats", "no-allow-repeats", "scale=", "config-file=",
                         "area=", 'align-x=', 'align-y=', 'optimization-time=', "pens=",
-                        'input-dpi=', 'tolerance=', 'send=', 'send-speed=', 'work-z=', 'lift-delta-z=', 'safe-delta-z=',
-                        'pen-down-speed=', 'pen-up-speed=', 'z-speed=', 'hpgl-out', 'no-hpgl-out', 'shading-threshold=',
+                        'input-dpi=', 'tolerance=', 'arc-fit', 'no-arc-fit', 'compact', 'no-compact', 'meatpack', 'no-meatpack', 'send=', 'send-speed=', 'work-z=', 'lift-delta-z=', 'safe-delta-z=',
+                        'pen-down-speed=', 'pen-up-speed=', 'z-speed=', 'acceleration=', 'junction-deviation=', 'hpgl-out', 'no-hpgl-out', 'shading-threshold=',
                         'shading-angle=', 'shading-crosshatch', 'no-shading-crosshatch', 'shading-avoid-outline',
                         'pause-at-start', 'no-pause-at-start', 'min-x=', 'max-x=', 'min-y=', 'max-y=',
-                        'no-shading-avoid-outline', 'shading-darkest=', 'shading-lightest=', 'stroke-all', 'no-stroke-all', 'gcode-pause', 'dump-options', 'tab=', 'extract-color=', 'sort', 'no-sort', 'simulation', 'no-simulation', 'tool-offset=', 'overcut=',
+                        'no-shading-avoid-outline', 'shading-darkest=', 'shading-lightest=', 'stroke-all', 'no-stroke-all', 'gcode-pause', 'dump-options', 'tab=', 'extract-color=', 'sort', 'no-sort', 'simulation', 'no-simulation', 'light-simulation', 'no-light-simulation', 'simulation-arrows', 'no-simulation-arrows', 'simulation-png', 'no-simulation-png', 'simulation-dpi=', 'tool-offset=', 'overcut=',
                         'boolean-shading-crosshatch=', 'boolean-sort=', 'tool-mode=', 'send-and-save=', 'direction=', 'lift-command=', 'down-command=',
-                        'init-code=', 'comment-delimiters=', 'end-code=', 'rel-code=' ], )
+                        'init-code=', 'comment-delimiters=', 'end-code=', 'rel-code=', 'parallel=', 'clip', 'no-clip', 'shading-backend=', 'shading-zigzag', 'no-shading-zigzag', 'shading-occlusion', 'no-shading-occlusion', 'shading-cache=', 'shading-contour', 'no-shading-contour', 'shading-layers=' ], )
 
         if len(args) + len(opts) == 0:
             raise getopt.GetoptError("invalid commandline")
@@ -858,6 +1373,18 @@ if __name__ == '__main__':
                     raise ValueError()
             elif opt in ('-t', '--tolerance'):
                 tolerance = float(arg)
+            elif opt == '--arc-fit':
+                arcFit = True
+            elif opt == '--no-arc-fit':
+                arcFit = False
+            elif opt == '--compact':
+                compact = True
+            elif opt == '--no-compact':
+                compact = False
+            elif opt == '--meatpack':
+                meatpack = True
+            elif opt == '--no-meatpack':
+                meatpack = False
             elif opt in ('-s', '--send'):
                 sendPort = None if len(arg.strip()) == 0 else arg
             elif opt == '--send-and-save':
@@ -902,6 +1429,10 @@ if __name__ == '__main__':
                 plotter.drawSpeed = float(arg)
             elif opt in ('-u', '--z-speed'):
                 plotter.zSpeed = float(arg)
+            elif opt == '--acceleration':
+                plotter.acceleration = float(arg)
+            elif opt == '--junction-deviation':
+                plotter.junctionDeviation = float(arg)
             elif opt in ('-H', '--hpgl-out'):
                 hpglOut = True
             elif opt == '--no-hpgl-out':
@@ -963,6 +1494,24 @@ if __name__ == '__main__':
                 svgSimulation = True
             elif opt == '--no-simulation':
                 svgSimulation = False
+            elif opt == '--light-simulation':
+                svgSimulation = True
+                lightSimulation = True
+            elif opt == '--no-light-simulation':
+                svgSimulation = False
+                lightSimulation = False
+            elif opt == '--simulation-arrows':
+                simulationArrows = True
+            elif opt == '--no-simulation-arrows':
+                simulationArrows = False
+            elif opt == '--simulation-png':
+                svgSimulation = True
+                simulationPng = True
+            elif opt == '--no-simulation-png':
+                svgSimulation = False
+                simulationPng = False
+            elif opt == '--simulation-dpi':
+                simulationDpi = float(arg)
             elif opt == '--tab':
                 quiet = True # Inkscape
             elif opt == "--tool-mode":
@@ -986,6 +1535,34 @@ if __name__ == '__main__':
                 relCode = arg == "true"
             elif opt == "--inc-homing":
                 incHoming = arg == "true"
+            elif opt == '--parallel':
+                processes = int(arg)
+            elif opt == '--shading-layers':
+                shader.layers = int(arg)
+            elif opt == '--shading-contour':
+                shader.contour = True
+            elif opt == '--no-shading-contour':
+                shader.contour = False
+            elif opt == '--shading-zigzag':
+                shader.link = True
+            elif opt == '--no-shading-zigzag':
+                shader.link = False
+            elif opt == '--shading-occlusion':
+                occlusion = True
+            elif opt == '--no-shading-occlusion':
+                occlusion = False
+            elif opt == '--shading-cache':
+                shader.cache = None if maybeNone(arg) is None else HatchCache(arg)
+            elif opt == '--shading-backend':
+                if arg not in (Shader.BACKEND_PYTHON, Shader.BACKEND_NUMPY):
+                    raise ValueError("Unknown shading backend "+arg)
+                if arg not in Shader.backends():
+                    sys.stderr.write("No %s, shading with python.\n" % arg)
+                shader.backend = arg
+            elif opt == '--clip':
+                clip = True
+            elif opt == '--no-clip':
+                clip = False
             else:
                 raise ValueError("Unrecognized argument "+opt + " " + arg)
             i += 1
@@ -1029,6 +1606,9 @@ if __name__ == '__main__':
             print('align-y=none')
 
         print('tolerance=' + str(tolerance))
+        print('arc-fit' if arcFit else 'no-arc-fit')
+        print('compact' if compact else 'no-compact')
+        print('meatpack' if meatpack else 'no-meatpack')
 
         if sendPort is not None:
             print('send=' + str(sendPort))
@@ -1044,12 +1624,20 @@ if __name__ == '__main__':
         print('pen-down-speed=%g' % (plotter.drawSpeed))
         print('pen-up-speed=%g' % (plotter.moveSpeed))
         print('z-speed=%g' % (plotter.zSpeed))
+        print('acceleration=%g' % (plotter.acceleration))
+        print('junction-deviation=%g' % (plotter.junctionDeviation))
         print('hpgl-out' if hpglOut else 'no-hpgl-out')
         print('shading-threshold=%g' % (shader.unshadedThreshold))
         print('shading-lightest=%g' % (shader.lightestSpacing))
         print('shading-darkest=%g' % (shader.darkestSpacing))
         print('shading-angle=%g' % (shader.angle))
         print('shading-crosshatch' if shader.crossHatch else 'no-shading-crosshatch')
+        print('shading-layers=%d' % (shader.layers))
+        print('shading-contour' if shader.contour else 'no-shading-contour')
+        print('shading-zigzag' if shader.link else 'no-shading-zigzag')
+        print('shading-backend=' + shader.backend)
+        print('shading-cache=' + ('none' if shader.cache is None else shader.cache.filename))
+        print('shading-occlusion' if occlusion else 'no-shading-occlusion')
         print('stroke-all' if strokeAll else 'no-stroke-all')
         print('optimization-time=%g' % (optimizationTime))
         print('sort' if sortPaths else 'no-sort')
@@ -1058,12 +1646,18 @@ if __name__ == '__main__':
         print('tool-offset=%.3f' % toolOffset)
         print('overcut=%.3f' % overcut)
         print('simulation' if svgSimulation else 'no-simulation')
+        print('light-simulation' if lightSimulation else 'no-light-simulation')
+        print('simulation-arrows' if simulationArrows else 'no-simulation-arrows')
+        print('simulation-png' if simulationPng else 'no-simulation-png')
+        print('simulation-dpi=%g' % simulationDpi)
         print('direction=' + ('none' if directionAngle is None else '%.3f'%directionAngle))
         print('lift-command=' + ('none' if plotter.liftCommand is None else plotter.liftCommand))
         print('down-command=' + ('none' if plotter.downCommand is None else plotter.downCommand))
         print('init-code=' + ('none' if plotter.initCode is None else plotter.initCode))
         print('end-code=' + ('none' if plotter.endCode is None else plotter.endCode))
         print('comment-delimiters=' + ('none' if plotter.comment is None else plotter.comment))
+        print('parallel=%d' % processes)
+        print('clip' if clip else 'no-clip')
 
         sys.exit(0)
 
@@ -1106,11 +1700,26 @@ if __name__ == '__main__':
         sys.stderr.write("Unrecognized file.\n")
         exit(1)
 
+    clipArea = None
+    if clip:
+        if scalingMode != SCALE_NONE or align != [ALIGN_NONE, ALIGN_NONE]:
+            sys.stderr.write("Clipping only works with --scale=none and no alignment; not clipping.\n")
+        else:
+            # without scaling, emitGcode() offsets the drawing by the lower left corner of the print area
+            clipArea = ((0.,0.), (plotter.xyMax[0]-plotter.xyMin[0], plotter.xyMax[1]-plotter.xyMin[1]))
+
     shader.setDrawingDirectionAngle(directionAngle)
     if svgTree is not None:
-        penData = parseSVG(svgTree, tolerance=tolerance, shader=shader, strokeAll=strokeAll, pens=pens, extractColor=extractColor)
+        penData = parseSVG(svgTree, tolerance=tolerance, shader=shader, strokeAll=strokeAll, pens=pens, extractColor=extractColor, processes=processes if processes > 0 else None, clipArea=clipArea, occlusion=occlusion)
+        try:
+            if shader.cache is not None:
+                shader.cache.save()
+        except (IOError, OSError) as e:
+            sys.stderr.write("Cannot save shading cache: %s\n" % e)
     else:
         penData = parseHPGL(data, dpi=dpi)
+    if clipArea is not None:
+        penData = clipToArea(penData, clipArea[0], clipArea[1])
     penData = removePenBob(penData)
 
     if doDedup:
@@ -1143,11 +1752,19 @@ if __name__ == '__main__':
         for pen in sorted(penData):
             sys.stderr.write(describePen(pens, pen)+"\n")
 
+    preview = None
+
     if hpglOut and not svgSimulation:
         g = emitHPGL(penData, pens=pens)
     else:
+        if svgSimulation and simulationPng:
+            from gcodeplotutils.preview import Preview
+
+            preview = Preview(plotter.xyMin, plotter.xyMax, dpi=simulationDpi)
         g = emitGcode(penData, align=align, scalingMode=scalingMode, tolerance=tolerance,
-                plotter=plotter, gcodePause=gcodePause, pens=pens, pauseAtStart=pauseAtStart, simulation=svgSimulation, relCode = relCode, incHoming = incHoming)
+                plotter=plotter, gcodePause=gcodePause, pens=pens, pauseAtStart=pauseAtStart, simulation=svgSimulation, relCode = relCode, incHoming = incHoming, arcs = arcFit,
+                compact = compact, metadata = sendPort is not None, lightSimulation = lightSimulation, simulationArrows = simulationArrows,
+                preview = preview)
 
     if g:
         dump = True
@@ -1155,18 +1772,33 @@ if __name__ == '__main__':
         if sendPort is not None and not svgSimulation:
             import gcodeplotutils.sendgcode as sendgcode
 
-            dump = sendAndSave
+            dump = False
 
             if hpglOut:
                 sendgcode.sendHPGL(port=sendPort, speed=sendSpeed, commands=g)
+                if sendAndSave:
+                    sys.stdout.write(g)
             else:
-                sendgcode.sendGcode(port=sendPort, speed=sendSpeed, commands=g, gcodePause=gcodePause, plotter=plotter, variables=plotter.variables, formulas=plotter.formulas)
+                # the program is generated once, and saved as it is sent
+                sendgcode.sendGcode(port=sendPort, speed=sendSpeed, commands=echoCommands(plotter, g, sys.stdout, comment=plotter.comment) if sendAndSave else g,
+                        gcodePause=gcodePause, plotter=plotter, variables=plotter.variables, formulas=plotter.formulas, meatpack=meatpack)
 
         if dump:
             if hpglOut:
                 sys.stdout.write(g)
+            elif preview is not None:
+                for command in g:
+                    pass
+                getattr(sys.stdout, 'buffer', sys.stdout).write(preview.png())
+            elif meatpack and not svgSimulation:
+                import gcodeplotutils.meatpack
+
+                # comments are left out of packed output anyway
+                stream = getattr(sys.stdout, 'buffer', sys.stdout)
+                for chunk in gcodeplotutils.meatpack.packLines(g):
+                    stream.write(chunk)
             else:
-                print('\n'.join(fixComments(plotter, g, comment=plotter.comment)))
+                writeLines(fixComments(plotter, g, comment=plotter.comment), sys.stdout)
 
     else:
         sys.stderr.write("No points.")
@@ -0,0 +1,114 @@
+from __future__ import print_function
+import sys
+
+# MeatPack, the packing of G-code that Marlin and Prusa firmware understand when built with MEATPACK: the
+# fifteen commonest characters go in four bits, two to a byte, and the rest follow the byte they belong to
+# in full. The host switches packing on and off with a two-byte signal and a command byte.
+
+SIGNAL = b'\xff\xff'
+ENABLE_PACKING = 0xFB
+DISABLE_PACKING = 0xFA
+RESET = 0xF9
+
+PACKED = '0123456789. \nGX'
+FULL = 0xF
+
+CODES = dict((c, i) for i,c in enumerate(PACKED))
+
+def signal(command):
+    return SIGNAL + bytes(bytearray((command,)))
+
+def packLine(line):
+    """
+    Returns the packed bytes for a line of G-code, with its comment and surrounding whitespace left out,
+    or b'' if there is no command. The firmware drops what is packed after a newline in the same byte, so
+    an odd length is made up with a space there.
+    """
+    line = line.split(';', 1)[0].strip()
+    if not line:
+        return b''
+    line += '\n' if len(line) % 2 else '\n '
+    out = bytearray()
+    for i in range(0, len(line), 2):
+        first = CODES.get(line[i], FULL)
+        second = CODES.get(line[i+1], FULL)
+        out.append(first | (second << 4))
+        if first == FULL:
+            out.append(ord(line[i]))
+        if second == FULL:
+            out.append(ord(line[i+1]))
+    return bytes(out)
+
+def packLines(commands, batch=4096):
+    """
+    Yields the packed bytes for commands, a batch of lines at a time, between the signals that switch packing
+    on and off again
+    """
+    yield signal(ENABLE_PACKING)
+    buffer = []
+    for command in commands:
+        for line in command.split('\n'):
+            buffer.append(packLine(line))
+            if len(buffer) >= batch:
+                yield b''.join(buffer)
+                buffer = []
+    if buffer:
+        yield b''.join(buffer)
+    yield signal(DISABLE_PACKING)
+
+def unpack(data):
+    """Returns the text for packed data, following the signals the way the firmware does"""
+    data = bytearray(data)
+    out = []
+    packing = False
+    pending = []
+    i = 0
+    while i < len(data):
+        byte = data[i]
+        i += 1
+        if byte == 0xFF and i < len(data) and data[i] == 0xFF:
+            if i + 1 >= len(data):
+                raise ValueError("Signal without a command")
+            command = data[i+1]
+            i += 2
+            if command == ENABLE_PACKING:
+                packing = True
+            elif command in (DISABLE_PACKING, RESET):
+                packing = False
+            else:
+                raise ValueError("Unknown MeatPack command 0x%02X" % command)
+        elif not packing:
+            out.append(chr(byte))
+        else:
+            first = byte & 0xF
+            second = byte >> 4
+            if first == FULL:
+                if i >= len(data):
+                    raise ValueError("Truncated MeatPack data")
+                out.append(chr(data[i]))
+                i += 1
+            else:
+                out.append(PACKED[first])
+                if PACKED[first] == '\n':
+                    continue
+            if second == FULL:
+                if i >= len(data):
+                    raise ValueError("Truncated MeatPack data")
+                out.append(chr(data[i]))
+                i += 1
+            else:
+                out.append(PACKED[second])
+    return ''.join(out)
+
+if __name__ == '__main__':
+    # check: python -m gcodeplotutils.meatpack file.gcode
+    with open(sys.argv[1]) as f:
+        text = f.read()
+    packed = b''.join(packLines([text]))
+    expected = [line.split(';', 1)[0].strip() for line in text.split('\n')]
+    expected = [line for line in expected if line]
+    unpacked = [line for line in unpack(packed).split('\n') if line]
+    if unpacked != expected:
+        raise AssertionError("Packed lines do not unpack to the commands")
+    plain = sum(len(line) + 1 for line in expected)
+    print("%d lines: %d bytes of commands packed in %d (%.1f%%)" % (len(expected), plain, len(packed), 100. * len(packed) / plain))
@@ -0,0 +1,170 @@
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Planner(object):
+    """
+    Estimates how long a machine with limited acceleration takes over a series of straight moves, planning them
+    the way grbl and Marlin do. The speed through each corner is limited by the junction deviation, and each move
+    gets a trapezoidal speed profile that leaves its corners no faster than the moves after them allow.
+
+    Moves are kept in flat arrays, so a million of them take a few tens of megabytes. times() uses numpy when it
+    is available: with P the running sum of 2*acceleration*length, the backward pass (the squared speed v[i] into
+    move i is at most v[i+1] + 2*acceleration*length[i]) is a suffix minimum of limit + P, less P, and the
+    forward pass is the same from the other end.
+    """
+    def __init__(self, acceleration=500., junctionDeviation=0.05, position=(0.,0.,0.)):
+        """acceleration in mm/s^2 (0 for none, that is, moves at full speed), junctionDeviation in mm"""
+        self.acceleration = acceleration
+        self.junctionDeviation = junctionDeviation
+        self.position = tuple(position)
+        self.lengths = array('d')
+        self.directions = array('d')
+        self.speeds = array('d')
+        self.stops = array('b')
+        self.groups = array('l')
+        self.group = 0
+        self.mustStop = True
+
+    def moveTo(self, x, y, z, speed):
+        """Adds a move in mm at speed in mm/s"""
+        dx = x - self.position[0]
+        dy = y - self.position[1]
+        dz = z - self.position[2]
+        self.position = (x, y, z)
+        length = math.sqrt(dx*dx + dy*dy + dz*dz)
+        if length == 0:
+            return
+        self.lengths.append(length)
+        self.directions.extend((dx / length, dy / length, dz / length))
+        self.speeds.append(speed)
+        self.stops.append(self.mustStop)
+        self.groups.append(self.group)
+        self.mustStop = False
+
+    def setPosition(self, x=None, y=None, z=None):
+        """Sets the axes that are given without a move, as after a tool change, and stops there"""
+        self.position = tuple(self.position[i] if value is None else value for i,value in enumerate((x, y, z)))
+        self.stop()
+
+    def stop(self):
+        """Makes the machine come to a stop before the next move, as at a pause"""
+        self.mustStop = True
+
+    def setGroup(self, group):
+        """Counts the moves from now on towards group in times()"""
+        self.group = group
+
+    def times(self):
+        """Returns a dictionary of the time in seconds for the moves in each group"""
+        if not self.lengths:
+            return {}
+        if numpy is not None:
+            perMove = self._numpyTimes()
+            totals = numpy.bincount(numpy.frombuffer(self.groups, dtype=self.groups.typecode), weights=perMove)
+            return dict((group, float(totals[group])) for group in sorted(set(self.groups)))
+        out = {}
+        for group,time in zip(self.groups, self._pythonTimes()):
+            out[group] = out.get(group, 0.) + time
+        return out
+
+    def _pythonTimes(self):
+        n = len(self.lengths)
+        a = self.acceleration
+        if a <= 0:
+            return [self.lengths[i] / self.speeds[i] for i in range(n)]
+
+        # limits on the squared speed at the start of each move, and 0 at the end of the last
+        limits = [0.] * (n + 1)
+        d = self.directions
+        for i in range(1, n):
+            if self.stops[i]:
+                continue
+            cosine = -(d[3*i-3] * d[3*i] + d[3*i-2] * d[3*i+1] + d[3*i-1] * d[3*i+2])
+            limit = min(self.speeds[i-1], self.speeds[i]) ** 2
+            if cosine > 0.999999:
+                limit = 0.
+            elif cosine > -0.999999:
+                sinHalf = math.sqrt(0.5 * (1. - cosine))
+                limit = min(limit, a * self.junctionDeviation * sinHalf / (1. - sinHalf))
+            limits[i] = limit
+
+        for i in range(n - 1, -1, -1):
+            limits[i] = min(limits[i], limits[i+1] + 2 * a * self.lengths[i])
+        for i in range(1, n + 1):
+            limits[i] = min(limits[i], limits[i-1] + 2 * a * self.lengths[i-1])
+
+        times = []
+        for i in range(n):
+            length = self.lengths[i]
+            top = self.speeds[i]
+            start = limits[i]
+            end = limits[i+1]
+            accelerating = (top * top - start) / (2 * a)
+            decelerating = (top * top - end) / (2 * a)
+            if accelerating + decelerating <= length:
+                times.append((top - math.sqrt(start)) / a + (top - math.sqrt(end)) / a + (length - accelerating - decelerating) / top)
+            else:
+                peak = math.sqrt((2 * a * length + start + end) / 2.)
+                times.append((2 * peak - math.sqrt(start) - math.sqrt(end)) / a)
+        return times
+
+    def _numpyTimes(self):
+        lengths = numpy.frombuffer(self.lengths)
+        speeds = numpy.frombuffer(self.speeds)
+        a = self.acceleration
+        if a <= 0:
+            return lengths / speeds
+
+        n = len(lengths)
+        d = numpy.frombuffer(self.directions).reshape(n, 3)
+        cosine = -(d[:-1] * d[1:]).sum(axis=1)
+        limit = numpy.minimum(speeds[:-1], speeds[1:]) ** 2
+        sinHalf = numpy.sqrt(numpy.clip(0.5 * (1. - cosine), 0., 1.))
+        with numpy.errstate(divide='ignore'):
+            deviation = a * self.junctionDeviation * sinHalf / (1. - sinHalf)
+        limit = numpy.where(cosine > -0.999999, numpy.minimum(limit, deviation), limit)
+        limit[cosine > 0.999999] = 0.
+        limit[numpy.frombuffer(self.stops, dtype=numpy.int8)[1:] != 0] = 0.
+        limits = numpy.concatenate(([0.], limit, [0.]))
+
+        reach = numpy.concatenate(([0.], numpy.cumsum(2 * a * lengths)))
+        limits = numpy.minimum.accumulate((limits + reach)[::-1])[::-1] - reach
+        limits = numpy.minimum(limits, numpy.minimum.accumulate(limits - reach) + reach)
+        limits = numpy.maximum(limits, 0.)
+
+        start = limits[:-1]
+        end = limits[1:]
+        accelerating = (speeds * speeds - start) / (2 * a)
+        decelerating = (speeds * speeds - end) / (2 * a)
+        cruise = accelerating + decelerating <= lengths
+        peak = numpy.where(cruise, speeds, numpy.sqrt(numpy.maximum(0., (2 * a * lengths + start + end) / 2.)))
+        return ((2 * peak - numpy.sqrt(start) - numpy.sqrt(end)) / a
+                + numpy.where(cruise, (lengths - accelerating - decelerating) / speeds, 0.))
+
+if __name__ == '__main__':
+    # benchmark: python -m gcodeplotutils.planner [moves]
+    import random
+    import sys
+    import time
+
+    random.seed(1)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    planner = Planner()
+    t0 = time.time()
+    for i in range(n):
+        if i % 1000 == 0:
+            planner.setGroup(i // (n // 3 + 1) + 1)
+        planner.moveTo(random.uniform(0, 200), random.uniform(0, 200), 0., 40.)
+    t1 = time.time()
+    times = planner.times()
+    t2 = time.time()
+    sys.stderr.write("%d moves: %.3fs to add, %.3fs to plan (%s), %.1f s of moves by group %s\n" % (n, t1-t0, t2-t1,
+        'numpy' if numpy is not None else 'python', sum(times.values()), ', '.join('%d: %.1f' % item for item in sorted(times.items()))))
+    if numpy is not None:
+        python = sum(planner._pythonTimes())
+        sys.stderr.write("python passes agree to %.2g\n" % (abs(python - sum(times.values())) / python))
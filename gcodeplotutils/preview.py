@@ -0,0 +1,138 @@
+from __future__ import print_function
+import math
+import struct
+import zlib
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Preview(object):
+    """
+    A picture of the moves of a job, drawn one pixel wide on a white RGB framebuffer and written out as a PNG.
+    The lines are only kept until png() rasterizes them, so that the travel moves can go underneath all the
+    drawing. A line covers the pixels nearest to it, one for each step along its longer axis, as with
+    Bresenham's algorithm; numpy, when it is available, does that a batch of lines at a time.
+    """
+    TRAVEL_COLOR = (0, 128, 0)
+
+    def __init__(self, xyMin, xyMax, dpi=100.):
+        self.scale = dpi / 25.4
+        self.width = max(1, int(math.ceil((xyMax[0] - xyMin[0]) * self.scale)) + 1)
+        self.height = max(1, int(math.ceil((xyMax[1] - xyMin[1]) * self.scale)) + 1)
+        # pixel x is x * scale - left and pixel y is top - y * scale
+        self.left = xyMin[0] * self.scale
+        self.top = self.height - 1 + xyMin[1] * self.scale
+        self.travels = array('d')
+        # (color, array of x0,y0,x1,y1 in pixels) for each run of lines of one color
+        self.layers = []
+        self.color = None
+        self.lines = None
+
+    def line(self, start, end, color):
+        """Adds a line in mm with color given as (r, g, b) from 0 to 1"""
+        if color != self.color:
+            self.color = color
+            self.lines = array('d')
+            self.layers.append((tuple(int(math.floor(255 * c + 0.5)) for c in color), self.lines))
+        s = self.scale
+        self.lines.extend((start[0] * s - self.left, self.top - start[1] * s, end[0] * s - self.left, self.top - end[1] * s))
+
+    def travel(self, start, end):
+        """Adds a move with the pen up"""
+        s = self.scale
+        self.travels.extend((start[0] * s - self.left, self.top - start[1] * s, end[0] * s - self.left, self.top - end[1] * s))
+
+    def render(self):
+        """Returns the framebuffer as a bytearray of RGB rows, top to bottom"""
+        buffer = bytearray(b'\xff' * (3 * self.width * self.height))
+        draw = self._numpyDraw if numpy is not None else self._pythonDraw
+        draw(buffer, self.travels, self.TRAVEL_COLOR)
+        for color,lines in self.layers:
+            draw(buffer, lines, color)
+        return buffer
+
+    def _pythonDraw(self, buffer, lines, color):
+        width = self.width
+        height = self.height
+        pixel = bytes(bytearray(color))
+        floor = math.floor
+        for i in range(0, len(lines), 4):
+            x0 = int(floor(lines[i] + 0.5))
+            y0 = int(floor(lines[i+1] + 0.5))
+            dx = int(floor(lines[i+2] + 0.5)) - x0
+            dy = int(floor(lines[i+3] + 0.5)) - y0
+            n = max(abs(dx), abs(dy), 1)
+            inside = 0 <= x0 < width and 0 <= y0 < height and 0 <= x0 + dx < width and 0 <= y0 + dy < height
+            for k in range(n + 1):
+                # the nearest pixel, rounding halves up as numpy does below
+                x = x0 + (2 * dx * k + n) // (2 * n)
+                y = y0 + (2 * dy * k + n) // (2 * n)
+                if inside or (0 <= x < width and 0 <= y < height):
+                    p = 3 * (y * width + x)
+                    buffer[p:p+3] = pixel
+
+    def _numpyDraw(self, buffer, lines, color, batch=200000):
+        pixels = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(-1, 3)
+        ends = numpy.floor(numpy.frombuffer(lines).reshape(-1, 4) + 0.5).astype(numpy.int64)
+        for b in range(0, len(ends), batch):
+            x0,y0,x1,y1 = ends[b:b+batch].T
+            dx = x1 - x0
+            dy = y1 - y0
+            n = numpy.maximum(numpy.maximum(abs(dx), abs(dy)), 1)
+            counts = n + 1
+            which = numpy.repeat(numpy.arange(len(n)), counts)
+            k = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            n = n[which]
+            x = x0[which] + (2 * dx[which] * k + n) // (2 * n)
+            y = y0[which] + (2 * dy[which] * k + n) // (2 * n)
+            inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+            pixels[(y * self.width + x)[inside]] = color
+
+    def png(self):
+        """Returns the picture as PNG data"""
+        def chunk(kind, body):
+            return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xFFFFFFFF)
+
+        buffer = self.render()
+        stride = 3 * self.width
+        raw = b''.join(b'\x00' + bytes(buffer[y*stride:(y+1)*stride]) for y in range(self.height))
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+if __name__ == '__main__':
+    # benchmark: python -m gcodeplotutils.preview [moves [out.png]]
+    import random
+    import sys
+    import time
+
+    random.seed(1)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    preview = Preview((0, 0), (200, 200), dpi=150)
+    t0 = time.time()
+    x,y = 100.,100.
+    for i in range(n):
+        x1 = min(200., max(0., x + random.uniform(-3, 3)))
+        y1 = min(200., max(0., y + random.uniform(-3, 3)))
+        if i % 20 == 0:
+            preview.travel((x, y), (x1, y1))
+        else:
+            preview.line((x, y), (x1, y1), (0., 0., 1.) if i < n // 2 else (1., 0., 0.))
+        x,y = x1,y1
+    t1 = time.time()
+    data = preview.png()
+    t2 = time.time()
+    sys.stderr.write("%d moves: %.3fs to add, %.3fs to render (%s) a %dx%d PNG of %d bytes\n" % (n, t1-t0, t2-t1,
+        'numpy' if numpy is not None else 'python', preview.width, preview.height, len(data)))
+    if numpy is not None:
+        buffer = bytearray(preview.render())
+        python = bytearray(b'\xff' * len(buffer))
+        preview._pythonDraw(python, preview.travels, Preview.TRAVEL_COLOR)
+        for color,lines in preview.layers:
+            preview._pythonDraw(python, lines, color)
+        sys.stderr.write("python rasterizer %s\n" % ('agrees' if python == buffer else 'DISAGREES'))
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'wb') as f:
+            f.write(data)
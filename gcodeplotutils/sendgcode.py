@@ -4,6 +4,7 @@ import os
 import re
 import sys
 from .evaluate import *
+from . import meatpack as mp
 
 try:
     from serial import Serial
@@ -18,13 +19,13 @@ except:
     from serial import Serial
 
 class FakeSerial(object):
-    def __init__(self, name):
+    def __init__(self, name, binary=False):
         if name == 'stdout':
-            self.handle = sys.stdout
+            self.handle = getattr(sys.stdout, 'buffer', sys.stdout) if binary else sys.stdout
         elif name == 'stderr':
-            self.handle = sys.stderr
+            self.handle = getattr(sys.stderr, 'buffer', sys.stderr) if binary else sys.stderr
         else:
-            self.handle = open(name, "w")
+            self.handle = open(name, "wb" if binary else "w")
         
     def flushInput(self):
         return
@@ -42,15 +43,20 @@ def sendHPGL(port, commands):
     s.write(commands)
     s.close()
 
-def sendGcode(port, commands, speed=115200, xonxoff=True, quiet = False, gcodePause="@pause", plotter=None, variables={}, formulas={}):
+def sendGcode(port, commands, speed=115200, xonxoff=True, quiet = False, gcodePause="@pause", plotter=None, variables={}, formulas={}, meatpack=False):
+    """
+    Sends the commands with line numbers and checksums, stopping at pauses for the user. With meatpack,
+    the lines are packed for firmware with MeatPack support.
+    """
     class State(object):
         pass
         
-    commandsSplit = []
-    for cmd in commands:
-        commandsSplit += cmd.split("\n")
+    def lines(commands):
+        for cmd in commands:
+            for line in cmd.split("\n"):
+                yield line
         
-    commands = commandsSplit
+    commands = lines(commands)
         
     state = State()
     state.cmd = None
@@ -62,10 +68,16 @@ def sendGcode(port, commands, speed=115200, xonxoff=True, quiet = False, gcodePa
         text_input = input
     
     if port.startswith('file:'):
-        s = FakeSerial(port[5:])
+        s = FakeSerial(port[5:], binary=meatpack)
     else:
         s = Serial(port, speed, xonxoff=xonxoff)
     s.flushInput()
+
+    def write(text):
+        if meatpack:
+            s.write(b''.join(mp.packLine(line) for line in text.split('\n')))
+        else:
+            s.write(text)
     
     class State(object):
         pass
@@ -74,7 +86,9 @@ def sendGcode(port, commands, speed=115200, xonxoff=True, quiet = False, gcodePa
     state.relative = False
     state.lineNumber = 1
 
-    s.write('\nM110 N1\n')
+    if meatpack:
+        s.write(mp.signal(mp.ENABLE_PACKING))
+    write('\nM110 N1\n')
 
 ## TODO: flow control  
     state.lineNumber = 2
@@ -121,7 +135,7 @@ def sendGcode(port, commands, speed=115200, xonxoff=True, quiet = False, gcodePa
                             
             command = 'N' + str(state.lineNumber) + ' ' + c
             command += '*' + str(checksum(command))
-            s.write(command+'\n')
+            write(command+'\n')
             s.flushInput()
             state.lineNumber += 1
     
@@ -173,6 +187,8 @@ Commands available:
                     break
                 elif cmd.startswith('a'):
                     print("Aborting.")
+                    if meatpack:
+                        s.write(mp.signal(mp.DISABLE_PACKING))
                     s.close()
                     sys.exit(0)
                 elif cmdOriginalCase[0] in 'GMT':
@@ -220,6 +236,8 @@ Commands available:
                     print("Unknown command.")
         else:
             sendCommand(c)
+    if meatpack:
+        s.write(mp.signal(mp.DISABLE_PACKING))
     s.close()
     
 if __name__ == '__main__':
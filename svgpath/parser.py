@@ -2,15 +2,21 @@
 
 import re
 from . import path
+from .path import TransformedPath
+from .raster import RasterImage, dataFromURI
 import xml.etree.ElementTree as ET
 import re
 import math
+import struct
+from array import array
 
 COMMANDS = set('MmZzLlHhVvCcSsQqTtAa')
 UPPERCASE = set('MZLHVCSQTA')
 
 COMMAND_RE = re.compile("([MmZzLlHhVvCcSsQqTtAa])")
 FLOAT_RE = re.compile("[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?")
+PATH_RE = re.compile("([MmZzLlHhVvCcSsQqTtAa])([^MmZzLlHhVvCcSsQqTtAa]*)")
+ARGUMENT_COUNTS = { 'M':2, 'L':2, 'H':1, 'V':1, 'C':6, 'S':4, 'Q':4, 'T':2, 'A':7 }
 
 SVG_COLORS = {
 "aliceblue": (0.941176,0.972549,1),
@@ -163,11 +169,70 @@ SVG_COLORS = {
 }
 
 def _tokenize_path(pathdef):
-    for x in COMMAND_RE.split(pathdef):
-        if x in COMMANDS:
-            yield x
-        for token in FLOAT_RE.findall(x):
-            yield token
+    """
+    Splits path data into a list of (command, arguments) pairs in a single pass.
+    The arguments of each command are converted in bulk into an array('d').
+    """
+    first = COMMAND_RE.search(pathdef)
+    if FLOAT_RE.search(pathdef if first is None else pathdef[:first.start()]):
+        raise ValueError("Unallowed implicit command in %s, position 0" % pathdef)
+    return [(command, array('d', map(float, FLOAT_RE.findall(arguments))))
+                for command, arguments in PATH_RE.findall(pathdef)]
+
+class Matrix(tuple):
+    """
+    An affine transformation, stored as the top two rows (a,b,c, d,e,f) of its matrix,
+    so that it maps (x,y) to (a*x+b*y+c, d*x+e*y+f). Since matrices are immutable, whether
+    the transformation is the identity or a pure translation is worked out just once, and
+    those cases skip the multiplications. Calling a matrix applies it to a complex number.
+    """
+    GENERAL = 0
+    TRANSLATION = 1
+    IDENTITY = 2
+
+    def __new__(cls, values):
+        self = tuple.__new__(cls, values)
+        a,b,c,d,e,f = self
+        if a == 1 and b == 0 and d == 0 and e == 1:
+            self.kind = Matrix.TRANSLATION if c or f else Matrix.IDENTITY
+        else:
+            self.kind = Matrix.GENERAL
+        return self
+
+    def __repr__(self):
+        return 'Matrix(%s)' % tuple.__repr__(self)
+
+    def __call__(self, z):
+        if self.kind == Matrix.IDENTITY:
+            return z
+        elif self.kind == Matrix.TRANSLATION:
+            return complex(z.real + self[2], z.imag + self[5])
+        return complex(z.real * self[0] + z.imag * self[1] + self[2],
+                 z.real * self[3] + z.imag * self[4] + self[5] )
+
+    def multiply(self, other):
+        """Returns the transformation that applies other and then self."""
+        if other.kind == Matrix.IDENTITY:
+            return self
+        elif self.kind == Matrix.IDENTITY:
+            return other
+        a1,b1,c1,d1,e1,f1 = self
+        a2,b2,c2,d2,e2,f2 = other
+        if other.kind == Matrix.TRANSLATION:
+            return Matrix((a1, b1, a1*c2 + b1*f2 + c1, d1, e1, d1*c2 + e1*f2 + f1))
+        elif self.kind == Matrix.TRANSLATION:
+            return Matrix((a2, b2, c2 + c1, d2, e2, f2 + f1))
+        return Matrix((a1*a2 + b1*d2, a1*b2 + b1*e2, a1*c2 + b1*f2 + c1,
+                       d1*a2 + e1*d2, d1*b2 + e1*e2, d1*c2 + e1*f2 + f1))
+
+    @property
+    def strokeScale(self):
+        """Average of the factors by which lengths along the two axes are scaled."""
+        try:
+            return self._strokeScale
+        except AttributeError:
+            self._strokeScale = (math.hypot(self[1], self[4]) + math.hypot(self[0], self[3])) / 2
+            return self._strokeScale
 
 def applyMatrix(matrix, z):
     return complex(z.real * matrix[0] + z.imag * matrix[1] + matrix[2], 
@@ -178,23 +243,72 @@ def matrixMultiply(matrix1, matrix2):
         return matrix2
     elif matrix2 is None:
         return matrix1
-        
-    m1 = [matrix1[0:3], matrix1[3:6] ] # don't need last row
-    m2 = [matrix2[0:3], matrix2[3:6], [0,0,1]]
+    if not isinstance(matrix1, Matrix):
+        matrix1 = Matrix(matrix1)
+    if not isinstance(matrix2, Matrix):
+        matrix2 = Matrix(matrix2)
+    return matrix1.multiply(matrix2)
 
-    out = []
-    
-    for i in range(2):
-        for j in range(3):
-            out.append( sum(m1[i][k]*m2[k][j] for k in range(3)) )
-            
-    return out
+def parseTransform(transform):
+    """
+    Parses an SVG transform attribute into the list of matrices it is made of.
+    """
+    matrices = []
+
+    for item in re.split(r'\)[\s,]+', transform.strip().lower()):
+        cmd = re.split(r'[,()\s]+', item)
+        
+        if cmd[0] == 'matrix':
+            a,b,c,d,e,f = map(float, cmd[1:7])
+            matrices.append(Matrix((a,c,e, b,d,f)))
+        elif cmd[0] == 'translate':
+            x = float(cmd[1])
+            if len(cmd) >= 3 and cmd[2] != '':
+                y = float(cmd[2])
+            else:
+                y = 0
+            matrices.append(Matrix((1,0,x, 0,1,y)))
+        elif cmd[0] == 'scale':
+            x = float(cmd[1])
+            if len(cmd) >= 3 and cmd[2] != '':
+                y = float(cmd[2])
+            else:
+                y = x
+            matrices.append(Matrix((x,0,0, 0,y,0)))
+        elif cmd[0] == 'rotate':
+            theta = float(cmd[1]) * math.pi / 180.
+            c = math.cos(theta)
+            s = math.sin(theta)
+            matrix = Matrix((c, -s, 0,  s, c, 0))
+            if len(cmd) >= 4 and cmd[2] != '':
+                x = float(cmd[2])
+                y = float(cmd[3])
+                matrix = matrix.multiply(Matrix((1,0,-x, 0,1,-y)))
+                matrix = Matrix((1,0,x, 0,1,y)).multiply(matrix)
+            matrices.append(matrix)
+        elif cmd[0] == 'skewx':
+            theta = float(cmd[1]) * math.pi / 180.
+            matrices.append(Matrix((1, math.tan(theta), 0,  0,1,0)))
+        elif cmd[0] == 'skewy':
+            theta = float(cmd[1]) * math.pi / 180.
+            matrices.append(Matrix((1,0,0, math.tan(theta),1,0)))
+
+    return matrices
 
 def parse_path(pathdef, current_pos=0j, matrix = None, svgState=None):
     if matrix is None:
-        scaler=lambda z : z
+        matrix = Matrix((1,0,0, 0,1,0))
+    elif not isinstance(matrix, Matrix):
+        matrix = Matrix(matrix)
+    scaler = matrix
+    if matrix.kind == Matrix.IDENTITY:
+        transform = complex
+    elif matrix.kind == Matrix.TRANSLATION:
+        m2,m5 = matrix[2],matrix[5]
+        transform = lambda x,y : complex(x + m2, y + m5)
     else:
-        scaler=lambda z : applyMatrix(matrix, z)
+        m0,m1,m2,m3,m4,m5 = matrix
+        transform = lambda x,y : complex(x * m0 + y * m1 + m2, x * m3 + y * m4 + m5)
     if svgState is None:
         svgState = path.SVGState()
 
@@ -202,170 +316,188 @@ def parse_path(pathdef, current_pos=0j, matrix = None, svgState=None):
     # specified as 'm'. This is the default behavior here as well.
     # But if you pass in a current_pos variable, the initial moveto
     # will be relative to that current_pos. This is useful.
-    elements = list(_tokenize_path(pathdef))
-    # Reverse for easy use of .pop()
-    elements.reverse()
-
-    segments = path.Path(svgState = svgState)
-    start_pos = None
-    command = None
-
-    while elements:
-
-        if elements[-1] in COMMANDS:
-            # New command.
-            last_command = command  # Used by S and T
-            command = elements.pop()
-            absolute = command in UPPERCASE
-            command = command.upper()
-        else:
-            # If this element starts with numbers, it is an implicit command
-            # and we don't change the command. Check that it's allowed:
-            if command is None:
-                raise ValueError("Unallowed implicit command in %s, position %s" % (
-                    pathdef, len(pathdef.split()) - len(elements)))
-            last_command = command  # Used by S and T
-
-        if command == 'M':
-            # Moveto command.
-            x = elements.pop()
-            y = elements.pop()
-            pos = float(x) + float(y) * 1j
-            if absolute:
-                current_pos = pos
-            else:
-                current_pos += pos
-
-            # when M is called, reset start_pos
-            # This behavior of Z is defined in svg spec:
-            # http://www.w3.org/TR/SVG/paths.html#PathDataClosePathCommand
-            start_pos = current_pos
-
-            # Implicit moveto commands are treated as lineto commands.
-            # So we set command to lineto here, in case there are
-            # further implicit commands after this moveto.
-            command = 'L'
-
-        elif command == 'Z':
+    segments = []
+    append = segments.append
+    closed = False
+    x = current_pos.real
+    y = current_pos.imag
+    # transformed current and start positions, so that each point of the path
+    # only goes through the matrix once
+    current = scaler(current_pos)
+    start_x = start_y = start = None
+    last_command = None  # Used by S and T
+
+    for letter, arguments in _tokenize_path(pathdef):
+        absolute = letter in UPPERCASE
+        command = letter.upper()
+        count = len(arguments)
+
+        if command == 'Z':
             # Close path
-            if current_pos != start_pos:
-                segments.append(path.Line(scaler(current_pos), scaler(start_pos)))
-            if len(segments):
-                segments.closed = True
-            current_pos = start_pos
-            start_pos = None
-            command = None  # You can't have implicit commands after closing.
-
-        elif command == 'L':
-            x = elements.pop()
-            y = elements.pop()
-            pos = float(x) + float(y) * 1j
-            if not absolute:
-                pos += current_pos
-            segments.append(path.Line(scaler(current_pos), scaler(pos)))
-            current_pos = pos
-
-        elif command == 'H':
-            x = elements.pop()
-            pos = float(x) + current_pos.imag * 1j
-            if not absolute:
-                pos += current_pos.real
-            segments.append(path.Line(scaler(current_pos), scaler(pos)))
-            current_pos = pos
-
-        elif command == 'V':
-            y = elements.pop()
-            pos = current_pos.real + float(y) * 1j
-            if not absolute:
-                pos += current_pos.imag * 1j
-            segments.append(path.Line(scaler(current_pos), scaler(pos)))
-            current_pos = pos
-
-        elif command == 'C':
-            control1 = float(elements.pop()) + float(elements.pop()) * 1j
-            control2 = float(elements.pop()) + float(elements.pop()) * 1j
-            end = float(elements.pop()) + float(elements.pop()) * 1j
-
-            if not absolute:
-                control1 += current_pos
-                control2 += current_pos
-                end += current_pos
-
-            segments.append(path.CubicBezier(scaler(current_pos), scaler(control1), scaler(control2), scaler(end)))
-            current_pos = end
-
-        elif command == 'S':
-            # Smooth curve. First control point is the "reflection" of
-            # the second control point in the previous path.
-
-            if last_command not in 'CS':
-                # If there is no previous command or if the previous command
-                # was not an C, c, S or s, assume the first control point is
-                # coincident with the current point.
-                control1 = scaler(current_pos)
-            else:
-                # The first control point is assumed to be the reflection of
-                # the second control point on the previous command relative
-                # to the current point.
-                control1 = 2 * scaler(current_pos) - segments[-1].control2
-
-            control2 = float(elements.pop()) + float(elements.pop()) * 1j
-            end = float(elements.pop()) + float(elements.pop()) * 1j
-
-            if not absolute:
-                control2 += current_pos
-                end += current_pos
-
-            segments.append(path.CubicBezier(scaler(current_pos), control1, scaler(control2), scaler(end)))
-            current_pos = end
-
-        elif command == 'Q':
-            control = float(elements.pop()) + float(elements.pop()) * 1j
-            end = float(elements.pop()) + float(elements.pop()) * 1j
-
-            if not absolute:
-                control += current_pos
-                end += current_pos
-
-            segments.append(path.QuadraticBezier(scaler(current_pos), scaler(control), scaler(end)))
-            current_pos = end
-
-        elif command == 'T':
-            # Smooth curve. Control point is the "reflection" of
-            # the second control point in the previous path.
-
-            if last_command not in 'QT':
-                # If there is no previous command or if the previous command
-                # was not an Q, q, T or t, assume the first control point is
-                # coincident with the current point.
-                control = scaler(current_pos)
-            else:
-                # The control point is assumed to be the reflection of
-                # the control point on the previous command relative
-                # to the current point.
-                control = 2 * scaler(current_pos) - segments[-1].control
-
-            end = float(elements.pop()) + float(elements.pop()) * 1j
-
-            if not absolute:
-                end += current_pos
-
-            segments.append(path.QuadraticBezier(scaler(current_pos), control, scaler(end)))
-            current_pos = end
-
-        elif command == 'A':
-            radius = float(elements.pop()) + float(elements.pop()) * 1j
-            rotation = float(elements.pop())
-            arc = float(elements.pop())
-            sweep = float(elements.pop())
-            end = float(elements.pop()) + float(elements.pop()) * 1j
-           
-            if not absolute:
-                end += current_pos
-
-            segments.append(path.Arc(current_pos, radius, rotation, arc, sweep, end, scaler))
-            current_pos = end
+            if count:
+                # You can't have implicit commands after closing.
+                raise ValueError("Unallowed implicit command in %s" % pathdef)
+            if start is not None:
+                if (x, y) != (start_x, start_y):
+                    append(path.Line(current, start))
+                if segments:
+                    end = segments[-1].end
+                    if not any(segment.start == end for segment in segments):
+                        raise ValueError("End does not coincide with a segment start.")
+                    closed = True
+                x = start_x
+                y = start_y
+                current = start
+            last_command = None
+            continue
+
+        size = ARGUMENT_COUNTS[command]
+        if count == 0 or count % size:
+            raise ValueError("Wrong number of arguments for %s in %s" % (letter, pathdef))
+
+        for i in range(0, count, size):
+            if command == 'M':
+                # Moveto command.
+                if absolute:
+                    x = arguments[i]
+                    y = arguments[i+1]
+                else:
+                    x += arguments[i]
+                    y += arguments[i+1]
+                current = transform(x, y)
+
+                # when M is called, reset start
+                # This behavior of Z is defined in svg spec:
+                # http://www.w3.org/TR/SVG/paths.html#PathDataClosePathCommand
+                start_x = x
+                start_y = y
+                start = current
+
+                # Implicit moveto commands are treated as lineto commands.
+                # So we set command to lineto here, in case there are
+                # further implicit commands after this moveto.
+                command = 'L'
+                last_command = command
+                continue
+
+            if command == 'L':
+                if absolute:
+                    x = arguments[i]
+                    y = arguments[i+1]
+                else:
+                    x += arguments[i]
+                    y += arguments[i+1]
+                end = transform(x, y)
+                append(path.Line(current, end))
+
+            elif command == 'H':
+                if absolute:
+                    x = arguments[i]
+                else:
+                    x += arguments[i]
+                end = transform(x, y)
+                append(path.Line(current, end))
 
+            elif command == 'V':
+                if absolute:
+                    y = arguments[i]
+                else:
+                    y += arguments[i]
+                end = transform(x, y)
+                append(path.Line(current, end))
+
+            elif command == 'C':
+                c1x, c1y, c2x, c2y, ex, ey = arguments[i:i+6]
+                if not absolute:
+                    c1x += x
+                    c1y += y
+                    c2x += x
+                    c2y += y
+                    ex += x
+                    ey += y
+                x = ex
+                y = ey
+                end = transform(x, y)
+                append(path.CubicBezier(current, transform(c1x, c1y), transform(c2x, c2y), end))
+
+            elif command == 'S':
+                # Smooth curve. First control point is the "reflection" of
+                # the second control point in the previous path.
+
+                if last_command not in ('C', 'S'):
+                    # If there is no previous command or if the previous command
+                    # was not an C, c, S or s, assume the first control point is
+                    # coincident with the current point.
+                    control1 = current
+                else:
+                    # The first control point is assumed to be the reflection of
+                    # the second control point on the previous command relative
+                    # to the current point.
+                    control1 = 2 * current - segments[-1].control2
+
+                c2x, c2y, ex, ey = arguments[i:i+4]
+                if not absolute:
+                    c2x += x
+                    c2y += y
+                    ex += x
+                    ey += y
+                x = ex
+                y = ey
+                end = transform(x, y)
+                append(path.CubicBezier(current, control1, transform(c2x, c2y), end))
+
+            elif command == 'Q':
+                cx, cy, ex, ey = arguments[i:i+4]
+                if not absolute:
+                    cx += x
+                    cy += y
+                    ex += x
+                    ey += y
+                x = ex
+                y = ey
+                end = transform(x, y)
+                append(path.QuadraticBezier(current, transform(cx, cy), end))
+
+            elif command == 'T':
+                # Smooth curve. Control point is the "reflection" of
+                # the second control point in the previous path.
+
+                if last_command not in ('Q', 'T'):
+                    # If there is no previous command or if the previous command
+                    # was not an Q, q, T or t, assume the first control point is
+                    # coincident with the current point.
+                    control = current
+                else:
+                    # The control point is assumed to be the reflection of
+                    # the control point on the previous command relative
+                    # to the current point.
+                    control = 2 * current - segments[-1].control
+
+                if absolute:
+                    x = arguments[i]
+                    y = arguments[i+1]
+                else:
+                    x += arguments[i]
+                    y += arguments[i+1]
+                end = transform(x, y)
+                append(path.QuadraticBezier(current, control, end))
+
+            elif command == 'A':
+                rx, ry, rotation, arc, sweep, ex, ey = arguments[i:i+7]
+                if not absolute:
+                    ex += x
+                    ey += y
+                arcSegment = path.Arc(complex(x, y), complex(rx, ry), rotation, arc, sweep, complex(ex, ey), scaler)
+                append(arcSegment)
+                x = ex
+                y = ey
+                end = arcSegment.end
+
+            current = end
+            last_command = command
+
+    segments = path.Path(*segments, svgState = svgState)
+    segments._closed = closed
     return segments
 
 def path_from_ellipse(x, y, rx, ry, matrix, state):
@@ -433,7 +565,11 @@ def rgbFromColor(colorName):
         return SVG_COLORS[colorName]        
         
         
-def getPathsFromSVG(svg):
+def getPathsFromSVG(svg, images=False):
+    """
+    Returns the paths in an SVG tree and the corners of its viewBox. With images, <image> elements with
+    embedded PNG, PGM or PPM data are returned among the paths as RasterImage objects.
+    """
     def updateStateCommand(state,cmd,arg):
         if cmd == 'fill':
             state.fill = rgbFromColor(arg)
@@ -469,63 +605,37 @@ def getPathsFromSVG(svg):
             except:
                 pass
                 
-        if state.strokeWidth and state.strokeWidthScaling:
-            # this won't work great for non-uniform scaling
-            h = abs(applyMatrix(matrix, complex(0,state.strokeWidth)) - applyMatrix(matrix, 0j))
-            w = abs(applyMatrix(matrix, complex(state.strokeWidth,0)) - applyMatrix(matrix, 0j))
-            state.strokeWidth = (h+w)/2
+        scaleStrokeWidth(state,matrix)
         return state
-        
-    def reorder(a,b,c,d,e,f):
-        return [a,c,e, b,d,f]            
+
+    def scaleStrokeWidth(state,matrix):
+        if matrix is not None and state.strokeWidth and state.strokeWidthScaling:
+            # this won't work great for non-uniform scaling
+            state.strokeWidth *= matrix.strokeScale
         
     def updateMatrix(tree, matrix):
         try:
-            transformList = re.split(r'\)[\s,]+', tree.attrib['transform'].strip().lower())
+            transform = tree.attrib['transform']
         except KeyError:
             return matrix
-            
-        for transform in transformList:
-            cmd = re.split(r'[,()\s]+', transform)
-            
-            updateMatrix = None
-            
-            if cmd[0] == 'matrix':
-                updateMatrix = reorder(*list(map(float, cmd[1:7])))
-            elif cmd[0] == 'translate':
-                x = float(cmd[1])
-                if len(cmd) >= 3 and cmd[2] != '':
-                    y = float(cmd[2])
-                else:
-                    y = 0
-                updateMatrix = reorder(1,0,0,1,x,y)
-            elif cmd[0] == 'scale':
-                x = float(cmd[1])
-                if len(cmd) >= 3 and cmd[2] != '':
-                    y = float(cmd[2])
-                else:
-                    y = x
-                updateMatrix = reorder(x,0,0, y,0,0)
-            elif cmd[0] == 'rotate':
-                theta = float(cmd[1]) * math.pi / 180.
-                c = math.cos(theta)
-                s = math.sin(theta)
-                updateMatrix = [c, -s, 0,  s, c, 0]
-                if len(cmd) >= 4 and cmd[2] != '':
-                    x = float(cmd[2])
-                    y = float(cmd[3])
-                    updateMatrix = matrixMultiply(updateMatrix, [1,0,-x, 0,1,-y])
-                    updateMatrix = matrixMultiply([1,0,x, 0,1,y], updateMatrix)
-            elif cmd[0] == 'skewX':
-                theta = float(cmd[1]) * math.pi / 180.
-                updateMatrix = [1, math.tan(theta), 0,  0,1,0]
-            elif cmd[0] == 'skewY':
-                theta = float(cmd[1]) * math.pi / 180.
-                updateMatrix = [1,0,0, math.tan(theta),1,0]
-                
-            matrix = matrixMultiply(matrix, updateMatrix)
-            
-        return matrix
+
+        key = (matrix, transform)
+        try:
+            return compositions[key]
+        except KeyError:
+            pass
+
+        try:
+            matrices = transforms[transform]
+        except KeyError:
+            matrices = parseTransform(transform)
+            transforms[transform] = matrices
+
+        composed = matrix
+        for local in matrices:
+            composed = matrixMultiply(composed, local)
+        compositions[key] = composed
+        return composed
         
     def updateStateAndMatrix(tree,state,matrix):
         matrix = updateMatrix(tree,matrix)
@@ -582,6 +692,18 @@ def getPathsFromSVG(svg):
             ry = getFloat('ry',default=None)
             path = path_from_rect(x,y,w,h,rx,ry, matrix,state)
             paths.append(path)
+        elif tag == 'image':
+            if images:
+                try:
+                    link = None
+                    for attribute in tree.attrib:
+                        if attribute.strip().lower() == 'href' or attribute.strip().lower().endswith('}href'):
+                            link = tree.attrib[attribute]
+                            break
+                    paths.append(RasterImage(dataFromURI(link), getFloat('x'), getFloat('y'), getFloat('width'), getFloat('height'),
+                                    tree.attrib.get('preserveAspectRatio', 'xMidYMid meet'), matrix=matrix, svgState=state))
+                except (ValueError, TypeError, KeyError, struct.error):
+                    pass
         elif tag == 'g' or tag == 'svg':
             for child in tree:
                 getPaths(paths, matrix, child, state, savedElements)
@@ -594,7 +716,17 @@ def getPathsFromSVG(svg):
                         break
                 if link is None or link[0] != '#':
                     raise KeyError
-                source = savedElements[link[1:]]
+                try:
+                    source = savedElements[link[1:]]
+                except KeyError:
+                    # not drawn before this point, e.g., inside <defs>
+                    if not documentElements:
+                        documentElements.update((element.attrib['id'], element) for element in svg.iter() if 'id' in element.attrib)
+                    source = documentElements[link[1:]]
+                if source in expanding:
+                    # a <use> inside what it refers to would never end
+                    cycles[0] += 1
+                    raise KeyError
                 x = 0
                 y = 0
                 try:
@@ -606,8 +738,32 @@ def getPathsFromSVG(svg):
                 except:
                     pass
                 # TODO: handle width and height? (Inkscape does not)
-                matrix = matrixMultiply(matrix, reorder(1,0,0,1,x,y))
-                getPaths(paths, matrix, source, state, dict(savedElements))
+                matrix = matrixMultiply(matrix, Matrix((1,0,x, 0,1,y)))
+                # the referenced geometry is parsed once under the linear part of the transformation, so
+                # that stroke widths and flattening are as for the element drawn there, and shared by all
+                # instances with the same inherited style that are only moved from one another
+                linear = Matrix((matrix[0], matrix[1], 0, matrix[3], matrix[4], 0))
+                translation = Matrix((1, 0, matrix[2], 0, 1, matrix[5]))
+                key = (source, linear, tuple(sorted(state.__dict__.items())))
+                try:
+                    instances = useCache[key]
+                except KeyError:
+                    localPaths = []
+                    cut = cycles[0]
+                    expanding.add(source)
+                    try:
+                        getPaths(localPaths, linear, source, state, dict(savedElements))
+                    finally:
+                        expanding.discard(source)
+                    instances = [ (localPath, {}) for localPath in localPaths ]
+                    # what is cut short by a cycle depends on where the <use> is, so is not shared
+                    if cycles[0] == cut:
+                        useCache[key] = instances
+                for localPath,approximations in instances:
+                    if isinstance(localPath, RasterImage):
+                        paths.append(localPath.transformed(translation))
+                        continue
+                    paths.append(TransformedPath(localPath, translation, approximations))
             except KeyError:
                 pass
 
@@ -617,6 +773,14 @@ def getPathsFromSVG(svg):
         return complex(x,y)
         
     paths = []
+    useCache = {}
+    # parsed transform attributes, and their compositions with the transformations of parent elements
+    transforms = {}
+    compositions = {}
+    documentElements = {}
+    # the elements referred to by the <use> elements being parsed, and how many cycles were cut
+    expanding = set()
+    cycles = [0]
 
     try:
         width = sizeFromString(svg.attrib['width'].strip())
@@ -690,6 +854,7 @@ def getPathsFromSVG(svg):
         matrix = [ width/viewBoxWidth, 0, -viewBox[0]* width/viewBoxWidth,  
                    0, -height/viewBoxHeight, viewBox[3]*height/viewBoxHeight ]
         
+    matrix = Matrix(matrix)
     getPaths(paths, matrix, svg, path.SVGState(), {})
 
     return ( paths, applyMatrix(matrix, complex(viewBox[0], viewBox[1])), 
@@ -697,4 +862,22 @@ def getPathsFromSVG(svg):
 
 def getPathsFromSVGFile(filename):
     return getPathsFromSVG(ET.parse(filename).getroot())
-    
\ No newline at end of file
+
+if __name__ == '__main__':
+    # benchmark on large path data: python -m svgpath.parser [number of commands]
+    import random
+    import sys
+    import time
+
+    random.seed(1)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    parts = ['M 0,0']
+    for i in range(n):
+        c = random.choice('LlCcQqHhVvSsTt')
+        count = ARGUMENT_COUNTS[c.upper()]
+        parts.append(c + ' ' + ' '.join('%.3f' % random.uniform(-100,100) for j in range(count)))
+    d = ' '.join(parts)
+    for matrix in (None, [0.5,0.1,10, -0.1,0.5,20]):
+        t0 = time.time()
+        segments = parse_path(d, matrix=matrix)
+        sys.stderr.write("%d commands (%d bytes, matrix=%s): %.3f seconds\n" % (len(segments), len(d), matrix, time.time()-t0))
@@ -1,5 +1,7 @@
 from __future__ import division
 from math import sqrt, cos, sin, acos, degrees, radians, log
+from copy import copy
+from bisect import bisect_left, bisect_right
 try:
     from collections.abc import MutableSequence
 except ImportError:
@@ -46,6 +48,12 @@ def approximate(path, start, end, start_point, end_point, max_error, depth, max_
         return ( approximate(path, start, mid, start_point, mid_point, max_error, depth+1, max_depth)[:-1] + 
                     approximate(path, mid, end, mid_point, end_point, max_error, depth+1, max_depth) )
                     
+def boundingBox(points):
+    """Returns the lower left and upper right corners of the box containing the points"""
+    xs = [point.real for point in points]
+    ys = [point.imag for point in points]
+    return complex(min(xs), min(ys)), complex(max(xs), max(ys))
+
 def removeCollinear(points, error, pointsToKeep=set()):
     out = []
     
@@ -79,12 +87,30 @@ class Segment(object):
         self.end = end
         
     def measure(self, start, end, error=ERROR, min_depth=MIN_DEPTH):
-        return Path(self).measure(start, end, error=error, min_depth=min_depth)
+        # same as Path(self).measure(), without computing the whole length for every partial measurement
+        if start <= 0. and end >= 1.:
+            return self.length(error=error, min_depth=MIN_DEPTH)
+        start = max(start, 0.)
+        end = min(end, 1.)
+        if end <= start:
+            return 0.
+        return segment_length(self, start, end, self.point(start), self.point(end), error, MIN_DEPTH, 0)
 
     def getApproximatePoints(self, error=0.001, max_depth=32):
         points = approximate(self, 0., 1., self.point(0.), self.point(1.), error, 0, max_depth)
         return points
 
+    def bbox(self):
+        """Returns the lower left and upper right corners of a box containing the segment"""
+        return boundingBox(self.controlPoints())
+
+    def transformed(self, scaler):
+        """Returns a copy of the segment with scaler applied to its points"""
+        segment = copy(self)
+        segment.start = scaler(self.start)
+        segment.end = scaler(self.end)
+        return segment
+
 class Line(Segment):
     def __init__(self, start, end):
         super(Line, self).__init__(start,end)
@@ -117,6 +143,12 @@ class Line(Segment):
         distance = (self.end - self.start)
         return sqrt(distance.real ** 2 + distance.imag ** 2)
 
+    def controlPoints(self):
+        return (self.start, self.end)
+
+    def transformed(self, scaler):
+        return Line(scaler(self.start), scaler(self.end))
+
 
 class CubicBezier(Segment):
     def __init__(self, start, control1, control2, end):
@@ -164,6 +196,13 @@ class CubicBezier(Segment):
         end_point = self.point(1)
         return segment_length(self, 0, 1, start_point, end_point, error, min_depth, 0)
 
+    def controlPoints(self):
+        # the curve is contained in their convex hull
+        return (self.start, self.control1, self.control2, self.end)
+
+    def transformed(self, scaler):
+        return CubicBezier(scaler(self.start), scaler(self.control1), scaler(self.control2), scaler(self.end))
+
 
 class QuadraticBezier(Segment):
     def __init__(self, start, control, end):
@@ -231,6 +270,13 @@ class QuadraticBezier(Segment):
                     log((2 * A2 + BA + Sabc) / (BA + C2))) / (4 * A32)
         return s
 
+    def controlPoints(self):
+        # the curve is contained in their convex hull
+        return (self.start, self.control, self.end)
+
+    def transformed(self, scaler):
+        return QuadraticBezier(scaler(self.start), scaler(self.control), scaler(self.end))
+
 class Arc(Segment):
     def __init__(self, start, radius, rotation, arc, sweep, end, scaler=lambda z:z):
         """radius is complex, rotation is in degrees,
@@ -354,6 +400,24 @@ class Arc(Segment):
         end_point = self.point(1)
         return segment_length(self, 0, 1, start_point, end_point, error, min_depth, 0)
 
+    def controlPoints(self):
+        # corners of the box around the whole ellipse before scaling; the
+        # scaler being affine, their image contains the arc
+        cosr = cos(radians(self.rotation))
+        sinr = sin(radians(self.rotation))
+        rx = self.radius.real
+        ry = self.radius.imag
+        w = sqrt((rx * cosr) ** 2 + (ry * sinr) ** 2)
+        h = sqrt((rx * sinr) ** 2 + (ry * cosr) ** 2)
+        return [self.start, self.end] + [self.scaler(self.center + complex(x, y)) for x in (-w, w) for y in (-h, h)]
+
+    def transformed(self, matrix):
+        # the center parameterization is in untransformed coordinates, so it can be shared, and
+        # matrix is composed with the arc's own
+        arc = super(Arc, self).transformed(matrix)
+        arc.scaler = matrix.multiply(self.scaler)
+        return arc
+
 class SVGState(object):
     def __init__(self, fill=(0.,0.,0.), fillOpacity=None, fillRule='nonzero', stroke=None, strokeOpacity=None, strokeWidth=0.1, strokeWidthScaling=True):
         self.fill = fill
@@ -428,13 +492,19 @@ class Path(MutableSequence):
         return not self == other
 
     def _calc_lengths(self, error=ERROR, min_depth=MIN_DEPTH):
-    ## TODO: check if error has decreased since last calculation
-        if self._length is not None:
+        # lengths computed with a smaller error and at least the same depth are good enough
+        if self._length is not None and self._lengths_error <= error and self._lengths_depth >= min_depth:
             return
 
         lengths = [each.length(error=error, min_depth=min_depth) for each in self._segments]
         self._length = sum(lengths)
         self._lengths = [each / (1 if self._length==0. else self._length) for each in lengths]
+        # _cumulative[i] is the position at which segment i starts
+        self._cumulative = [0.]
+        for each in self._lengths:
+            self._cumulative.append(self._cumulative[-1] + each)
+        self._lengths_error = error
+        self._lengths_depth = min_depth
 
     def point(self, pos, error=ERROR):
         # Shortcuts
@@ -444,17 +514,16 @@ class Path(MutableSequence):
             return self._segments[-1].point(pos)
 
         self._calc_lengths(error=error)
-        # Find which segment the point we search for is located on:
-        segment_start = 0
-        for index, segment in enumerate(self._segments):
-            segment_end = segment_start + self._lengths[index]
-            if segment_end >= pos:
-                # This is the segment! How far in on the segment is the point?
-                segment_pos = (pos - segment_start) / (segment_end - segment_start)
-                break
-            segment_start = segment_end
-
-        return segment.point(segment_pos)
+        # Find which segment the point we search for is located on: the first one ending at or after pos
+        index = min(bisect_left(self._cumulative, pos, 1) - 1, len(self._segments) - 1)
+        segment_start = self._cumulative[index]
+        segment_end = self._cumulative[index+1]
+        # How far in on the segment is the point?
+        if segment_end > segment_start:
+            segment_pos = (pos - segment_start) / (segment_end - segment_start)
+        else:
+            segment_pos = 0.
+        return self._segments[index].point(segment_pos)
 
     def length(self, error=ERROR, min_depth=MIN_DEPTH):
         self._calc_lengths(error, min_depth)
@@ -463,33 +532,41 @@ class Path(MutableSequence):
     def measure(self, start, end, error=ERROR, min_depth=MIN_DEPTH):
         self._calc_lengths(error=error)
         if start == 0.0 and end == 1.0:
-            return self.length()
+            return self._length
         length = 0
-        segment_start = 0
-        for index, segment in enumerate(self._segments):
+        # skip to the first segment ending after start
+        index = bisect_right(self._cumulative, start, 1) - 1
+        while index < len(self._segments):
+            segment_start = self._cumulative[index]
             if end <= segment_start:
                 break
-            segment_end = segment_start + self._lengths[index]
-            if start < segment_end:
-                # this segment intersects the part of the path we want
-                if start <= segment_start and segment_end <= end:
-                    # whole segment is contained in the part of the path
-                    length += self._lengths[index] * self._length
+            segment_end = self._cumulative[index+1]
+            # this segment intersects the part of the path we want
+            if start <= segment_start and segment_end <= end:
+                # whole segment is contained in the part of the path
+                length += self._lengths[index] * self._length
+            else:
+                if start <= segment_start:
+                    start_in_segment = 0. 
+                else:
+                    start_in_segment = (start-segment_start)/(segment_end-segment_start)
+                if segment_end <= end:
+                    end_in_segment = 1.
                 else:
-                    if start <= segment_start:
-                        start_in_segment = 0. 
-                    else:
-                        start_in_segment = (start-segment_start)/(segment_end-segment_start)
-                    if segment_end <= end:
-                        end_in_segment = 1.
-                    else:
-                        end_in_segment = (end-segment_start)/(segment_end-segment_start)
-                    segment = self._segments[index]
-                    length += segment_length(segment, start_in_segment, end_in_segment, segment.point(start_in_segment), 
-                                segment.point(end_in_segment), error, MIN_DEPTH, 0)
-            segment_start = segment_end
+                    end_in_segment = (end-segment_start)/(segment_end-segment_start)
+                segment = self._segments[index]
+                length += segment_length(segment, start_in_segment, end_in_segment, segment.point(start_in_segment), 
+                            segment.point(end_in_segment), error, MIN_DEPTH, 0)
+            index += 1
         return length
         
+    def bbox(self):
+        """Returns the lower left and upper right corners of a box containing the path"""
+        corners = []
+        for segment in self:
+            corners += segment.bbox()
+        return boundingBox(corners)
+
     def _is_closable(self):
         """Returns true if the end is on the start of a segment"""
         try:
@@ -646,4 +723,43 @@ class Path(MutableSequence):
             parts.append('Z')
 
         return ' '.join(parts)
-        
+
+class TransformedPath(Path):
+    """
+    A view of a Path moved by a translation Matrix, used for the <use> instances of an element
+    whose geometry is parsed only once. Segments are only transformed when accessed, and
+    linear approximations are made in the coordinates of the shared path and cached in
+    approximations, which is shared between all the views of the same path; a translation
+    changes no lengths, so they are the ones the moved path would have.
+    """
+
+    def __init__(self, source, scaler, approximations, svgState=None):
+        self.source = source
+        self.scaler = scaler
+        self.approximations = approximations
+        self._transformed = None
+        self._length = None
+        self._lengths = None
+        self._closed = source._closed
+        self.svgState = source.svgState if svgState is None else svgState
+
+    @property
+    def _segments(self):
+        if self._transformed is None:
+            self._transformed = [segment.transformed(self.scaler) for segment in self.source]
+        return self._transformed
+
+    def __len__(self):
+        return len(self.source)
+
+    def linearApproximation(self, error=0.001, max_depth=32):
+        key = (error, max_depth)
+        try:
+            approximation = self.approximations[key]
+        except KeyError:
+            approximation = self.source.linearApproximation(error=error, max_depth=max_depth)
+            self.approximations[key] = approximation
+
+        linearPath = Path(*(line.transformed(self.scaler) for line in approximation), svgState=self.svgState)
+        linearPath._closed = approximation._closed
+        return linearPath
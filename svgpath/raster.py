@@ -0,0 +1,260 @@
+# Raster images embedded in SVG, decoded a row at a time
+
+import base64
+import re
+import struct
+import zlib
+from .path import Path, boundingBox
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# channels for each PNG color type
+PNG_CHANNELS = { 0:1, 2:3, 3:1, 4:2, 6:4 }
+
+def dataFromURI(uri):
+    """Returns the bytes in a data: URI"""
+    match = re.match(r'\s*data:([^,]*?)(;base64)?,', uri, re.I)
+    if not match:
+        raise ValueError("Not a data URI")
+    data = uri[match.end():]
+    if match.group(2):
+        return base64.b64decode(re.sub(r'\s', '', data))
+    try:
+        from urllib.parse import unquote_to_bytes
+    except ImportError:
+        from urllib import unquote as unquote_to_bytes
+    return unquote_to_bytes(data)
+
+def pngHeader(data):
+    """Returns width, height, bit depth, color type and interlacing of a PNG"""
+    if data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        raise ValueError("Not a PNG")
+    return struct.unpack('>IIBBxxB', data[16:29])
+
+def pngChunks(data):
+    """Yields the (type, body) chunks of a PNG"""
+    pos = 8
+    while pos + 8 <= len(data):
+        length,kind = struct.unpack('>I4s', data[pos:pos+8])
+        yield kind, data[pos+8:pos+8+length]
+        pos += 12 + length
+        if kind == b'IEND':
+            break
+
+def pngRows(data):
+    """
+    Yields the rows of a PNG as bytes of gray levels from 0 (black) to 255 (white), with any transparency
+    composited over white. The pixel data is inflated and unfiltered as it is needed, so only two rows
+    are kept at a time.
+    """
+    width,height,depth,colorType,interlace = pngHeader(data)
+    if interlace:
+        raise ValueError("Interlaced PNG images are not supported")
+    channels = PNG_CHANNELS[colorType]
+    stride = (width * channels * depth + 7) // 8
+    bpp = max(1, channels * depth // 8)
+
+    # gray level of each palette entry, or of each sample for low bit depths
+    table = None
+    if colorType == 3:
+        palette = b''
+        alpha = b''
+        for kind,body in pngChunks(data):
+            if kind == b'PLTE':
+                palette = body
+            elif kind == b'tRNS':
+                alpha = body
+        table = bytearray(256)
+        for i in range(len(palette) // 3):
+            gray = sum(bytearray(palette[3*i:3*i+3])) // 3
+            a = bytearray(alpha)[i] if i < len(alpha) else 255
+            table[i] = (gray * a + 255 * (255 - a)) // 255
+    elif colorType == 0 and depth < 8:
+        table = bytearray(255 * i // ((1 << depth) - 1) for i in range(1 << depth)) + bytearray(256 - (1 << depth))
+
+    def unpack(row):
+        """Returns the 8-bit samples of a row"""
+        if depth == 8:
+            return row
+        elif depth == 16:
+            return row[0::2]
+        perByte = 8 // depth
+        mask = (1 << depth) - 1
+        samples = bytearray(len(row) * perByte)
+        for shift in range(perByte):
+            samples[shift::perByte] = bytearray((byte >> (8 - depth * (shift + 1))) & mask for byte in row)
+        return samples[:width * channels]
+
+    def gray(row):
+        samples = unpack(row)
+        if table is not None:
+            return bytes(samples).translate(table)
+        if colorType == 0:
+            return bytes(samples)
+        if colorType == 2:
+            return bytes(bytearray((r + g + b) // 3 for r,g,b in zip(samples[0::3], samples[1::3], samples[2::3])))
+        if colorType == 4:
+            return bytes(bytearray((g * a + 255 * (255 - a)) // 255 for g,a in zip(samples[0::2], samples[1::2])))
+        return bytes(bytearray(((r + g + b) * a // 3 + 255 * (255 - a)) // 255 for r,g,b,a in zip(samples[0::4], samples[1::4], samples[2::4], samples[3::4])))
+
+    inflate = zlib.decompressobj()
+    pending = b''
+    previous = bytearray(stride)
+    count = 0
+
+    def unfilter(kind, row):
+        if kind == 0:
+            return row
+        if kind == 2:
+            return bytearray((a + b) & 0xFF for a,b in zip(row, previous))
+        for i in range(len(row)):
+            left = row[i - bpp] if i >= bpp else 0
+            if kind == 1:
+                row[i] = (row[i] + left) & 0xFF
+            elif kind == 3:
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+            elif kind == 4:
+                up = previous[i]
+                upLeft = previous[i - bpp] if i >= bpp else 0
+                p = left + up - upLeft
+                pa = abs(p - left)
+                pb = abs(p - up)
+                pc = abs(p - upLeft)
+                if pa <= pb and pa <= pc:
+                    predictor = left
+                elif pb <= pc:
+                    predictor = up
+                else:
+                    predictor = upLeft
+                row[i] = (row[i] + predictor) & 0xFF
+            else:
+                raise ValueError("Bad PNG filter %d" % kind)
+        return row
+
+    def inflated():
+        try:
+            for kind,body in pngChunks(data):
+                if kind == b'IDAT':
+                    yield inflate.decompress(body)
+            yield inflate.flush()
+        except zlib.error as e:
+            raise ValueError("Bad PNG data: %s" % e)
+
+    for piece in inflated():
+        pending += piece
+        pos = 0
+        while pos + stride + 1 <= len(pending) and count < height:
+            previous = unfilter(bytearray(pending[pos:pos+1])[0], bytearray(pending[pos+1:pos+1+stride]))
+            yield gray(bytes(previous))
+            pos += stride + 1
+            count += 1
+        pending = pending[pos:]
+    if count < height:
+        raise ValueError("Truncated PNG")
+
+def pnmHeader(data):
+    """Returns the kind (b'P5' or b'P6'), width, height, maximum value and data offset of a binary PGM or PPM"""
+    match = re.match(br'(P[56])(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)\s', data)
+    if not match:
+        raise ValueError("Not a binary PGM or PPM")
+    return match.group(1), int(match.group(2)), int(match.group(3)), int(match.group(4)), match.end()
+
+def pnmRows(data):
+    """Yields the rows of a binary PGM or PPM like pngRows()"""
+    kind,width,height,maxValue,start = pnmHeader(data)
+    channels = 3 if kind == b'P6' else 1
+    size = 2 if maxValue > 255 else 1
+    stride = width * channels * size
+    scale = bytearray(min(255, 255 * i // maxValue) for i in range(256)) if maxValue != 255 and size == 1 else None
+    for y in range(height):
+        row = data[start + y * stride:start + (y + 1) * stride]
+        if len(row) < stride:
+            raise ValueError("Truncated PGM or PPM")
+        if size == 2:
+            row = bytes(bytearray(min(255, 255 * ((a << 8) | b) // maxValue) for a,b in zip(bytearray(row[0::2]), bytearray(row[1::2]))))
+        elif scale is not None:
+            row = row.translate(scale)
+        if channels == 3:
+            row = bytes(bytearray((r + g + b) // 3 for r,g,b in zip(bytearray(row[0::3]), bytearray(row[1::3]), bytearray(row[2::3]))))
+        yield row
+
+def imageSize(data):
+    """Returns the width and height of PNG, PGM or PPM data"""
+    if data[:8] == PNG_SIGNATURE:
+        return pngHeader(data)[:2]
+    return pnmHeader(data)[1:3]
+
+def grayRows(data):
+    return pngRows(data) if data[:8] == PNG_SIGNATURE else pnmRows(data)
+
+class RasterImage(object):
+    """
+    An <image> element with embedded PNG, PGM or PPM data. Only the encoded data is kept; rows() decodes it
+    again each time it is called. point() maps pixel coordinates (x right, y down, in pixels) to the drawing,
+    and window is the (x0, y0, x1, y1) part of the image in pixels that is shown.
+    """
+    def __init__(self, data, x, y, width, height, preserveAspectRatio='xMidYMid meet', matrix=None, svgState=None):
+        self.data = data
+        self.svgState = svgState
+        self.pixelWidth,self.pixelHeight = imageSize(data)
+        if not self.pixelWidth or not self.pixelHeight:
+            raise ValueError("Empty image")
+        # SVG does not render an image with no width or height
+        if not width > 0 or not height > 0:
+            raise ValueError("Image with no area")
+
+        # the same viewBox fitting as for the whole document
+        preserve = preserveAspectRatio.strip().lower().split()
+        if preserve and preserve[0] == 'none':
+            scaleX = width / float(self.pixelWidth)
+            scaleY = height / float(self.pixelHeight)
+            offsetX = x
+            offsetY = y
+        else:
+            align = preserve[0] if preserve and len(preserve[0]) == 8 else 'xmidymid'
+            scale = (max if len(preserve) >= 2 and preserve[1] == 'slice' else min)(width / float(self.pixelWidth), height / float(self.pixelHeight))
+            scaleX = scaleY = scale
+            offsetX = x + { 'xmin':0., 'xmid':0.5, 'xmax':1. }[align[0:4]] * (width - scale * self.pixelWidth)
+            offsetY = y + { 'ymin':0., 'ymid':0.5, 'ymax':1. }[align[4:8]] * (height - scale * self.pixelHeight)
+        self.window = (max(0., (x - offsetX) / scaleX), max(0., (y - offsetY) / scaleY),
+                       min(float(self.pixelWidth), (x + width - offsetX) / scaleX), min(float(self.pixelHeight), (y + height - offsetY) / scaleY))
+        self.local = (scaleX, offsetX, scaleY, offsetY)
+        self.matrix = matrix
+
+    def point(self, x, y):
+        scaleX,offsetX,scaleY,offsetY = self.local
+        z = complex(x * scaleX + offsetX, y * scaleY + offsetY)
+        return z if self.matrix is None else self.matrix(z)
+
+    def transformed(self, matrix, svgState=None):
+        """Returns the image placed under matrix, for <use>"""
+        image = RasterImage.__new__(RasterImage)
+        image.__dict__.update(self.__dict__)
+        image.matrix = matrix if self.matrix is None else matrix.multiply(self.matrix)
+        if svgState is not None:
+            image.svgState = svgState
+        return image
+
+    def rows(self):
+        return grayRows(self.data)
+
+    def bbox(self):
+        x0,y0,x1,y1 = self.window
+        return boundingBox([self.point(x0, y0), self.point(x1, y0), self.point(x0, y1), self.point(x1, y1)])
+
+    def linearApproximation(self, error=0.001, max_depth=32):
+        """An image has no outline"""
+        return Path(svgState=self.svgState)
+
+if __name__ == '__main__':
+    # check: python -m svgpath.raster
+    gray = b'P5 2 2 255\n\x00\x80\x80\xff'
+    for width,height in ((0., 2.), (2., 0.), (-1., 2.)):
+        try:
+            RasterImage(gray, 0., 0., width, height)
+        except ValueError:
+            continue
+        raise AssertionError("Image of %gx%g was not rejected" % (width, height))
+    image = RasterImage(gray, 0., 0., 4., 4.)
+    if image.window != (0., 0., 2., 2.) or image.point(2., 2.) != 4+4j:
+        raise AssertionError("Image is not placed on its box")
@@ -1,17 +1,150 @@
 import math
+import hashlib
+import json
+from array import array
+from collections import OrderedDict
 from operator import itemgetter
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class HatchCache(object):
+    """
+    Hatching by shape and options, independent of where the shape is, optionally stored in a file between runs.
+    As the scanlines are on a grid shared by all shapes, the options include where the shape is on that grid.
+    The entries are kept in the order they were last used, and when the cache is saved the ones used longest
+    ago are dropped until no more than limit coordinates are left.
+    """
+    # bump when the hatching changes, to ignore stale files
+    VERSION = 2
+    # coordinates are rounded to this for comparing shapes; a power of two, as flattened curves
+    # have many coordinates that are multiples of one, which would sit right between two multiples of 1e-6
+    QUANTUM = 2. ** -20
+    # coordinates kept in the file, about 20 bytes each
+    LIMIT = 1 << 21
+
+    def __init__(self, filename=None, limit=LIMIT):
+        self.filename = filename
+        self.limit = limit
+        self.entries = OrderedDict()
+        self.new = {}
+        self.used = set()
+        if filename is not None:
+            try:
+                with open(filename) as f:
+                    data = json.load(f, object_pairs_hook=OrderedDict)
+                if data.get('version') == HatchCache.VERSION:
+                    self.entries = OrderedDict((key, array('d', value)) for key,value in data['entries'].items())
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                pass
+
+    @staticmethod
+    def key(polygon, *options):
+        """Returns the origin the polygon is taken relative to and a key for it and the options"""
+        origin = polygon[0][0]
+        coordinates = array('q')
+        for line in polygon:
+            for z in line:
+                coordinates.append(int(round((z.real - origin.real) / HatchCache.QUANTUM)))
+                coordinates.append(int(round((z.imag - origin.imag) / HatchCache.QUANTUM)))
+        digest = hashlib.sha1(coordinates.tobytes())
+        digest.update(repr((HatchCache.VERSION,) + options).encode())
+        return origin, digest.hexdigest()
+
+    @staticmethod
+    def phase(origin, angleDegrees, spacing):
+        """
+        Where origin is between the scanlines for angleDegrees and spacing, in units of QUANTUM of the spacing;
+        two copies of a shape are hatched alike, moved, when this is the same for their origins
+        """
+        rotate = complex(math.cos(angleDegrees * math.pi / 180.), math.sin(angleDegrees * math.pi / 180.))
+        steps = int(round(1. / HatchCache.QUANTUM))
+        return int(round((origin / rotate).imag / spacing % 1. * steps)) % steps
+
+    def get(self, origin, key):
+        try:
+            data = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.entries[key] = data
+        self.used.add(key)
+        return [(complex(data[i],data[i+1])+origin, complex(data[i+2],data[i+3])+origin) for i in range(0,len(data),4)]
+
+    def put(self, origin, key, lines):
+        data = array('d')
+        for line in lines:
+            a = line[0] - origin
+            b = line[1] - origin
+            data.extend((a.real,a.imag,b.real,b.imag))
+        self.entries.pop(key, None)
+        self.entries[key] = data
+        self.new[key] = data
+
+    def takeNew(self):
+        """
+        Returns and forgets the entries added since the last call and the keys of the ones used, for merging
+        into another cache
+        """
+        new,used = self.new,self.used
+        self.new = {}
+        self.used = set()
+        return new, used
+
+    def merge(self, entries, used=()):
+        for key in used:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+        for key,data in entries.items():
+            self.entries.pop(key, None)
+            self.entries[key] = data
+        self.new.update(entries)
+
+    def prune(self):
+        """Drops the entries used longest ago until no more than limit coordinates are left"""
+        size = sum(len(data) for data in self.entries.values())
+        while size > self.limit:
+            key,data = self.entries.popitem(last=False)
+            size -= len(data)
+
+    def save(self):
+        if self.filename is not None and self.new:
+            self.prune()
+            with open(self.filename, 'w') as f:
+                json.dump({'version': HatchCache.VERSION, 'entries': OrderedDict((key, list(value)) for key,value in self.entries.items())}, f)
+            self.new = {}
+
 class Shader(object):
     MODE_EVEN_ODD = 0
     MODE_NONZERO = 1
 
-    def __init__(self, unshadedThreshold=1., lightestSpacing=3., darkestSpacing=0.5, angle=45, crossHatch=False):
+    BACKEND_PYTHON = 'python'
+    BACKEND_NUMPY = 'numpy'
+
+    # crossings computed at a time by the numpy backend
+    NUMPY_CHUNK = 1 << 18
+
+    # longest connector along the outline when linking hatch lines, in hatch spacings
+    LINK_DISTANCE = 4.
+
+    def __init__(self, unshadedThreshold=1., lightestSpacing=3., darkestSpacing=0.5, angle=45, crossHatch=False, backend=BACKEND_PYTHON, link=False, cache=None, contour=False, layers=1):
         self.unshadedThreshold = unshadedThreshold
         self.lightestSpacing = lightestSpacing
         self.darkestSpacing = darkestSpacing
         self.angle = angle
         self.secondaryAngle = angle + 90
-        self.crossHatch = False
+        self.crossHatch = crossHatch
+        self.backend = backend
+        self.link = link
+        self.cache = cache
+        self.contour = contour
+        self.layers = layers
+
+    @staticmethod
+    def backends():
+        """Returns the backends that can be used here"""
+        return [Shader.BACKEND_PYTHON] + ([Shader.BACKEND_NUMPY] if numpy is not None else [])
         
     def isActive(self):
         return self.unshadedThreshold > 0.000001
@@ -27,110 +160,840 @@ class Shader(object):
         if 90 < (self.secondaryAngle - drawingDirectionAngle) % 360 < 270:
             self.secondaryAngle = (self.secondaryAngle + 180) % 360
         
-    def shade(self, polygon, grayscale, avoidOutline=True, mode=None):
+    def layerAngle(self, angleDegrees):
+        """The hatching angle, turned around if need be to draw along the drawing direction"""
+        if self.drawingDirectionAngle is not None and 90 < (angleDegrees - self.drawingDirectionAngle) % 360 < 270:
+            return (angleDegrees + 180) % 360
+        return angleDegrees
+
+    def hatchLayers(self, spacing):
+        """
+        Returns the (angleDegrees, spacing) layers hatching a gray whose single-layer spacing is spacing.
+        Up to self.layers layers spread evenly over 180 degrees share the lines out between them, so darker
+        grays get more layers rather than tighter spacing; a layer is added only once the spacing of each
+        would still be no wider than lightestSpacing.
+        """
+        if self.crossHatch:
+            return [(self.angle, spacing), (self.angle+90, spacing)]
+        count = max(1, min(self.layers, int(self.lightestSpacing / spacing)))
+        return [(self.layerAngle(self.angle + 180. * i / count) if i else self.angle, spacing * count) for i in range(count)]
+
+    def spacing(self, grayscale):
+        """The spacing of the hatching for a gray, or None if it is left unshaded"""
+        if grayscale >= self.unshadedThreshold:
+            return None
+        intensity = (self.unshadedThreshold-grayscale) / float(self.unshadedThreshold)
+        return self.lightestSpacing * (1-intensity) + self.darkestSpacing * intensity
+
+    def shade(self, polygon, grayscale, avoidOutline=True, mode=None, occluders=None):
         if mode is None:
             mode = Shader.MODE_EVEN_ODD
-        if grayscale >= self.unshadedThreshold:
+        spacing = self.spacing(grayscale)
+        if spacing is None or not polygon:
             return []
-        intensity = (self.unshadedThreshold-grayscale) / float(self.unshadedThreshold)
-        spacing = self.lightestSpacing * (1-intensity) + self.darkestSpacing * intensity
-        lines = Shader.shadePolygon(polygon, self.angle, spacing, avoidOutline=avoidOutline, mode=mode, alternate=(self.drawingDirectionAngle is None))
-        if self.crossHatch:
-            lines += Shader.shadePolygon(polygon, self.angle+90, spacing, avoidOutline=avoidOutline, mode=mode, alternate=(self.drawingDirectionAngle is None))
+        if self.contour:
+            return self.shadeCached(polygon, [(None, spacing)], avoidOutline=avoidOutline, mode=mode, occluders=occluders)
+        return self.shadeCached(polygon, self.hatchLayers(spacing), avoidOutline=avoidOutline, mode=mode, occluders=occluders)
+
+    def shadeImage(self, image):
+        """
+        Hatches a raster image (see svgpath.raster.RasterImage) along its rows. The lines are darkestSpacing apart
+        and broken into dashes, so that the share of a line drawn around a point is darkestSpacing over the
+        spacing shade() gives the gray there: the same ink as a fill of that gray. The dashes come from
+        Floyd-Steinberg error diffusion over cells as long as the lines are apart, each cell taking the average
+        of the pixels in it. The image is decoded one row at a time, keeping only the cell sums for the line
+        being gathered and the errors carried to the next line.
+        """
+        x0,y0,x1,y1 = image.window
+        origin = image.point(0, 0)
+        alongRow = image.point(1, 0) - origin
+        alongColumn = image.point(0, 1) - origin
+        if x1 <= x0 or y1 <= y0 or not alongRow or not alongColumn:
+            return []
+
+        # lines and cells in pixels, lines centered on the image
+        lineStep = self.darkestSpacing / abs(alongColumn)
+        count = int(math.ceil((y1 - y0) / lineStep))
+        margin = ((y1 - y0) - (count - 1) * lineStep) / 2.
+        ys = [y0 + margin + i * lineStep for i in range(count)]
+        cells = max(1, int(math.ceil((x1 - x0) * abs(alongRow) / self.darkestSpacing)))
+        xs = [x0 + (x1 - x0) * i / cells for i in range(cells + 1)]
+        ranges = []
+        for i in range(cells):
+            a = min(int(xs[i]), image.pixelWidth - 1)
+            ranges.append((a, max(a + 1, min(int(math.ceil(xs[i+1])), image.pixelWidth))))
+
+        # share of a line to draw for each gray level
+        coverage = []
+        for level in range(256):
+            spacing = self.spacing(level / 255.)
+            coverage.append(0. if spacing is None else min(1., self.darkestSpacing / spacing))
+
+        if self.drawingDirectionAngle is None:
+            alternate = True
+            forward = True
+        else:
+            alternate = False
+            forward = alongRow.real * math.cos(self.drawingDirectionAngle * math.pi / 180.) + alongRow.imag * math.sin(self.drawingDirectionAngle * math.pi / 180.) >= 0
+
+        lines = []
+        errors = [0.] * (cells + 2)
+
+        def hatch(y, grays):
+            nextErrors = [0.] * (cells + 2)
+            step = 1 if forward else -1
+            start = None
+            for i in (range(cells) if forward else range(cells-1, -1, -1)):
+                share = coverage[int(grays[i] + 0.5)]
+                value = share + errors[i+1]
+                on = share > 0 and value >= 0.5
+                # nothing carries over out of unshaded parts, lest it bleed into them
+                error = value - 1. if on else (value if share > 0 else 0.)
+                errors[i+1+step] += error * 7 / 16.
+                nextErrors[i+1-step] += error * 3 / 16.
+                nextErrors[i+1] += error * 5 / 16.
+                nextErrors[i+1+step] += error / 16.
+                edge = xs[i] if forward else xs[i+1]
+                if on and start is None:
+                    start = edge
+                elif not on and start is not None:
+                    lines.append((image.point(start, y), image.point(edge, y)))
+                    start = None
+            if start is not None:
+                lines.append((image.point(start, y), image.point(xs[-1] if forward else xs[0], y)))
+            return nextErrors
+
+        # each row goes to the line whose band it ends in, or the next one
+        k = 0
+        sums = [0.] * cells
+        rowCount = 0
+        grays = None
+        for row,data in enumerate(image.rows()):
+            if k >= count or row >= y1:
+                break
+            if row + 1 <= y0:
+                continue
+            grays = [sum(bytearray(data[a:b])) / float(b - a) for a,b in ranges]
+            sums = [s + g for s,g in zip(sums, grays)]
+            rowCount += 1
+            while k < count and ys[k] + lineStep / 2. <= row + 1:
+                if rowCount:
+                    grays = [s / rowCount for s in sums]
+                    sums = [0.] * cells
+                    rowCount = 0
+                errors = hatch(ys[k], grays)
+                if alternate:
+                    forward = not forward
+                k += 1
+        while k < count and (rowCount or grays is not None):
+            if rowCount:
+                grays = [s / rowCount for s in sums]
+                rowCount = 0
+            errors = hatch(ys[k], grays)
+            if alternate:
+                forward = not forward
+            k += 1
+
         return lines
+
+    def shadeCached(self, polygon, layers, avoidOutline=True, mode=None, occluders=None):
+        """
+        shadeLayers() with this shader's options, or contourPolygon() for layers whose angle is None,
+        going through its cache if it has one; returns the lines of all the layers
+        """
+        alternate = self.drawingDirectionAngle is None
+
+        def fill(layers):
+            if layers and layers[0][0] is None:
+                return [Shader.contourPolygon(polygon, spacing, mode=mode, occluders=occluders, backend=self.backend) for angleDegrees,spacing in layers]
+            return Shader.shadeLayers(polygon, layers, avoidOutline=avoidOutline, mode=mode, alternate=alternate, backend=self.backend, link=self.link, occluders=occluders)
+
+        if self.cache is None or occluders or not polygon:
+            return [line for lines in fill(layers) for line in lines]
+
+        found = []
+        missing = []
+        for angleDegrees,spacing in layers:
+            if angleDegrees is None:
+                # contours follow the outline, wherever it is
+                options = (None, float(spacing))
+            else:
+                options = (float(angleDegrees), float(spacing), HatchCache.phase(polygon[0][0], angleDegrees, spacing))
+            origin,key = HatchCache.key(polygon, *(options + (avoidOutline, mode, alternate, self.link)))
+            lines = self.cache.get(origin, key)
+            found.append(lines)
+            if lines is None:
+                missing.append((angleDegrees, spacing, key))
+
+        # the layers not in the cache are hatched together
+        for (angleDegrees,spacing,key),lines in zip(missing, fill([(angleDegrees, spacing) for angleDegrees,spacing,key in missing])):
+            self.cache.put(origin, key, lines)
+            found[found.index(None)] = lines
+
+        return [line for lines in found for line in lines]
         
     @staticmethod
-    def shadePolygon(polygon, angleDegrees, spacing, avoidOutline=True, mode=None, alternate=True):
+    def shadePolygon(polygon, angleDegrees, spacing, avoidOutline=True, mode=None, alternate=True, backend=BACKEND_PYTHON, link=False, occluders=None):
+        """
+        The backend is BACKEND_PYTHON or BACKEND_NUMPY; the latter falls back to the former if numpy is missing.
+        Both give the same hatching.
+
+        With link (and alternate), hatch lines are joined into zig-zag strokes along the outline where possible.
+
+        occluders is a list of (polygon, mode) pairs for shapes covering this one; the hatching leaves out the
+        union of their interiors. This is the polygon difference of a scanline clipper, taken only at the scanlines
+        that get hatched.
+        """
+        return Shader.shadeLayers(polygon, [(angleDegrees, spacing)], avoidOutline=avoidOutline, mode=mode, alternate=alternate, backend=backend, link=link, occluders=occluders)[0]
+
+    @staticmethod
+    def shadeLayers(polygon, layers, avoidOutline=True, mode=None, alternate=True, backend=BACKEND_PYTHON, link=False, occluders=None):
+        """
+        Hatches the polygon once for each (angleDegrees, spacing) in layers, in one pass, returning a list of lines
+        for each layer; the options are those of shadePolygon().
+
+        The outline and the occluders are gathered once for all the layers, so each layer only needs a rotation
+        into its scanline frame before its own edge table is built.
+        """
         if mode is None:
             mode = Shader.MODE_EVEN_ODD
-    
-        rotate = complex(math.cos(angleDegrees * math.pi / 180.), math.sin(angleDegrees * math.pi / 180.))
-        
-        polygon = [(line[0] / rotate,line[1] / rotate) for line in polygon]
-        
-        spacing = float(spacing)
 
-        toAvoid = list(set(line[0].imag for line in polygon)|set(line[1].imag for line in polygon))
+        polygon = list(polygon)
+        if occluders:
+            occluders = [(list(occluder), occluderMode) for occluder,occluderMode in occluders]
+        link = link and alternate
 
-        if len(toAvoid) <= 1:
-            deltaY = (toAvoid[0]-spacing/2.) % spacing
-        else:
-            # find largest interval
-            toAvoid.sort()
-            largestIndex = 0
-            largestLen = 0
-            for i in range(len(toAvoid)):
-                l = ( toAvoid[i] - toAvoid[i-1] ) % spacing
-                if l > largestLen:
-                    largestIndex = i
-                    largestLen = l
-            deltaY = (toAvoid[largestIndex-1] + largestLen / 2.) % spacing
-            
+        results = []
+        for angleDegrees,spacing in layers:
+            rotate = complex(math.cos(angleDegrees * math.pi / 180.), math.sin(angleDegrees * math.pi / 180.))
+            results.append(Shader._hatch([(line[0] / rotate,line[1] / rotate) for line in polygon],
+                    float(spacing), avoidOutline, mode, alternate, backend, link,
+                    occluders and [([(line[0] / rotate,line[1] / rotate) for line in occluder], occluderMode) for occluder,occluderMode in occluders],
+                    rotate))
+        return results
+
+    @staticmethod
+    def _hatch(polygon, spacing, avoidOutline, mode, alternate, backend, link, occluders, rotate):
+        """
+        Hatches along the x-axis the polygon already turned into its scanline frame, turning the lines back by rotate
+        """
         minY = min(min(line[0].imag,line[1].imag) for line in polygon)
         maxY = max(max(line[0].imag,line[1].imag) for line in polygon)
 
-        y = minY + ( - minY ) % spacing + deltaY    
-        
-        if y > minY + spacing:
-            y -= spacing
-            
-        y += 0.01
-        
+        # scanlines are halfway between multiples of spacing, so that the hatching of neighboring shapes lines up
+        first = int(math.ceil(minY / spacing - 0.5))
+        ys = []
+        y = (first + 0.5) * spacing
+        while y < maxY:
+            ys.append(y)
+            y = (first + len(ys) + 0.5) * spacing
+
+        rows = []
+
         odd = False
 
         all = []
-        
-        while y < maxY:
-            intersections = []
-            for line in polygon:
-                z = line[0]
-                z1 = line[1]
-                if z1.imag == y or z.imag == y: # roundoff generated corner case -- ignore -- TODO
-                    break
-                if z1.imag < y < z.imag or z.imag < y < z1.imag:
-                    if z1.real == z.real:
-                        intersections.append(( complex(z.real, y), z.imag<y, line))
-                    else:
-                        m = (z1.imag-z.imag)/(z1.real-z.real)
-                        # m * (x - z.real) = y - z.imag
-                        # so: x = (y - z.imag) / m + z.real
-                        intersections.append( (complex((y-z.imag)/m + z.real, y), z.imag<y, line) )
-        
-            intersections.sort(key=lambda datum: datum[0].real)
-            
-            thisLine = []
-            if mode == Shader.MODE_EVEN_ODD:
-                for i in range(0,len(intersections)-1,2):
-                    thisLine.append((intersections[i], intersections[i+1]))
-            elif mode == Shader.MODE_NONZERO:
-                count = 0
-                for i in range(0,len(intersections)-1):
-                    if intersections[i][1]:
-                        count += 1
-                    else:
-                        count -= 1
-                    if count != 0:
-                        thisLine.append((intersections[i], intersections[i+1]))
-            else:
-                raise ValueError()
+
+        for thisLine in Shader._regionSpans(polygon, ys, mode, occluders, backend):
+            if link:
+                rows.append(thisLine)
+                continue
                    
             if odd and alternate:
                 thisLine = list(reversed([(l[1],l[0]) for l in thisLine]))
                 
-            if not avoidOutline and len(thisLine) and len(all) and all[-1][1][2] == thisLine[0][0][2]:
+            if not avoidOutline and len(thisLine) and len(all) and all[-1][1][2] is not None and all[-1][1][2] == thisLine[0][0][2]:
                 # follow along outline to avoid an extra pen bob
                 all.append( (all[-1][1], thisLine[0][0]) )
                 
             all += thisLine
                 
             odd = not odd
-                
-            y += spacing
+
+        if link:
+            return [(line[0]*rotate, line[1]*rotate) for line in Shader._zigzag(polygon, rows, spacing * Shader.LINK_DISTANCE)]
 
         return [(line[0][0]*rotate, line[1][0]*rotate) for line in all]
-    
-                    
+
+    @staticmethod
+    def _edgeTable(polygon):
+        """
+        Returns the edges sorted by lower endpoint; edges include their lower endpoint but not their upper one,
+        so a scanline through a vertex crosses the outline the right number of times and horizontal edges
+        never cross a scanline
+        """
+        edges = []
+        for index,line in enumerate(polygon):
+            z = line[0]
+            z1 = line[1]
+            if z.imag != z1.imag:
+                m = None if z1.real == z.real else (z1.imag-z.imag)/(z1.real-z.real)
+                edges.append((min(z.imag,z1.imag), max(z.imag,z1.imag), index, line, m, z.imag < z1.imag))
+        edges.sort(key=itemgetter(0,2))
+        return edges
+
+    @staticmethod
+    def _crossings(edges, ys, backend):
+        """
+        Yields the crossings of each scanline as (point, upward, line, index) tuples sorted left to right
+        """
+        if backend == Shader.BACKEND_NUMPY and numpy is not None and edges:
+            return Shader._numpyCrossings(edges, ys)
+        else:
+            return Shader._pythonCrossings(edges, ys)
+
+    @staticmethod
+    def _regionSpans(polygon, ys, mode, occluders=None, backend=BACKEND_PYTHON):
+        """
+        Yields the spans inside the polygon but outside the (polygon, mode) occluders along each scanline
+        """
+        scan = Shader._crossings(Shader._edgeTable(polygon), ys, backend)
+        if occluders:
+            occluders = [(Shader._crossings(Shader._edgeTable(occluder), ys, backend), occluderMode) for occluder,occluderMode in occluders]
+
+        for intersections in scan:
+            spans = Shader._spans(intersections, mode)
+            if occluders:
+                # advance all of them to keep them at this scanline
+                covered = [span for occluder,occluderMode in occluders for span in Shader._spans(next(occluder), occluderMode)]
+                if covered:
+                    spans = Shader._uncovered(spans, covered)
+            yield spans
+
+    @staticmethod
+    def _spans(intersections, mode):
+        """
+        Pairs up the crossings of a scanline into the spans inside the polygon
+        """
+        spans = []
+        if mode == Shader.MODE_EVEN_ODD:
+            for i in range(0,len(intersections)-1,2):
+                if intersections[i][0] != intersections[i+1][0]:
+                    spans.append((intersections[i], intersections[i+1]))
+        elif mode == Shader.MODE_NONZERO:
+            count = 0
+            for i in range(0,len(intersections)-1):
+                if intersections[i][1]:
+                    count += 1
+                else:
+                    count -= 1
+                if count != 0 and intersections[i][0] != intersections[i+1][0]:
+                    spans.append((intersections[i], intersections[i+1]))
+        else:
+            raise ValueError()
+        return spans
+
+    @staticmethod
+    def _uncovered(spans, covered):
+        """
+        Returns the parts of the spans of a scanline outside the covered ones. The new endpoints
+        are not on the outline, so they have no line or index, but they have the line of the
+        cover as a fifth element.
+        """
+        merged = []
+        for start,end,startLine,endLine in sorted((span[0][0].real, span[1][0].real, span[0][2], span[1][2]) for span in covered):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
+                    merged[-1][3] = endLine
+            else:
+                merged.append([start, end, startLine, endLine])
+
+        out = []
+        k = 0
+        for a,b in spans:
+            y = a[0].imag
+            while k < len(merged) and merged[k][1] <= a[0].real:
+                k += 1
+            start = a
+            j = k
+            while start is not None and j < len(merged) and merged[j][0] < b[0].real:
+                if merged[j][0] > start[0].real:
+                    out.append((start, (complex(merged[j][0], y), None, None, None, merged[j][2])))
+                start = (complex(merged[j][1], y), None, None, None, merged[j][3]) if merged[j][1] < b[0].real else None
+                j += 1
+            if start is not None:
+                out.append((start, b))
+        return out
+
+    @staticmethod
+    def contourPolygon(polygon, spacing, mode=None, occluders=None, backend=BACKEND_PYTHON):
+        """
+        Fills the polygon with contours parallel to its outline, spacing apart and starting spacing/2 inside it,
+        nested contours being linked into spirals.
+
+        The contours are offsets of the outline, found as level sets of the distance to it. The distance is
+        sampled on a grid spacing/2 apart: exactly along the grid lines, from where they cross the outline,
+        and from there across them with a distance transform, except near the outline, where the distance to its edges
+        is used. Edges inside a nonzero fill are taken as outline there.
+        """
+        if mode is None:
+            mode = Shader.MODE_EVEN_ODD
+
+        spacing = float(spacing)
+        step = spacing / 2.
+
+        x0 = min(min(line[0].real,line[1].real) for line in polygon) - step
+        y0 = min(min(line[0].imag,line[1].imag) for line in polygon) - step
+        columns = int(math.ceil((max(max(line[0].real,line[1].real) for line in polygon) - x0) / step)) + 2
+        rows = int(math.ceil((max(max(line[0].imag,line[1].imag) for line in polygon) - y0) / step)) + 2
+        gridX = [x0 + i * step for i in range(columns)]
+        gridY = [y0 + j * step for j in range(rows)]
+
+        def alongLines(polygon, occluders, lines, points):
+            """
+            For each of the horizontal lines, returns the squared distances from the points on it to where
+            it crosses the outline, the edges crossed there and whether the points are inside
+            """
+            out = []
+            for spans in Shader._regionSpans(polygon, lines, mode, occluders, backend):
+                crossings = []
+                for a,b in spans:
+                    if crossings and crossings[-1][0] == a[0].real:
+                        # touching spans
+                        crossings.pop()
+                    else:
+                        crossings.append((a[0].real, a[2] if a[2] is not None else a[4]))
+                    crossings.append((b[0].real, b[2] if b[2] is not None else b[4]))
+                distances = []
+                edges = []
+                inside = []
+                k = 0
+                for x in points:
+                    while k < len(crossings) and crossings[k][0] <= x:
+                        k += 1
+                    left = x - crossings[k-1][0] if k > 0 else float('inf')
+                    right = crossings[k][0] - x if k < len(crossings) else float('inf')
+                    if left < right:
+                        distances.append(left * left)
+                        edges.append(crossings[k-1][1])
+                    else:
+                        distances.append(right * right)
+                        edges.append(crossings[k][1] if k < len(crossings) else None)
+                    inside.append(k % 2 == 1)
+                out.append((distances, edges, inside))
+            return out
+
+        def transform(f):
+            """
+            Felzenszwalb and Huttenlocher's distance transform of sampled squared distances f, step apart;
+            returns, for each sample, the one nearest to it in that sense
+            """
+            n = len(f)
+            hull = []
+            starts = []
+            for q in range(n):
+                if f[q] == float('inf'):
+                    continue
+                start = float('-inf')
+                while hull:
+                    p = hull[-1]
+                    start = ((f[q] + (q * step) ** 2) - (f[p] + (p * step) ** 2)) / (2 * step * step * (q - p))
+                    if start > starts[-1]:
+                        break
+                    hull.pop()
+                    starts.pop()
+                    start = float('-inf')
+                hull.append(q)
+                starts.append(start)
+            out = [None] * n
+            if hull:
+                k = 0
+                for q in range(n):
+                    while k + 1 < len(hull) and starts[k+1] < q:
+                        k += 1
+                    out[q] = hull[k]
+            return out
+
+        def edgeDistance(p, edge):
+            if edge is None:
+                return float('inf')
+            a,b = edge
+            d = b - a
+            length2 = d.real * d.real + d.imag * d.imag
+            t = ((p - a) * d.conjugate()).real / length2 if length2 else 0.
+            t = 0. if t < 0 else (1. if t > 1 else t)
+            return abs(p - a - t * d)
+
+        def swap(polygon):
+            return [(complex(line[0].imag,line[0].real), complex(line[1].imag,line[1].real)) for line in polygon]
+
+        # the samples along rows, carried across them down the columns, and the other way around with the axes
+        # swapped; the exact distance to the edges of the nearest samples is then taken, which also gets right
+        # the distance to corners, which are rarely sampled
+        rowPass = alongLines(polygon, occluders, gridY, gridX)
+        columnPass = alongLines(swap(polygon), occluders and [(swap(occluder), occluderMode) for occluder,occluderMode in occluders], gridX, gridY)
+        nearestRows = [transform([rowPass[j][0][i] for j in range(rows)]) for i in range(columns)]
+        nearestColumns = [transform([columnPass[i][0][j] for i in range(columns)]) for j in range(rows)]
+        inside = [row[2] for row in rowPass]
+
+        distance = []
+        for j in range(rows):
+            row = []
+            for i in range(columns):
+                p = complex(gridX[i], gridY[j])
+                nearestRow = nearestRows[i][j]
+                nearestColumn = nearestColumns[j][i]
+                row.append(min(edgeDistance(p, rowPass[nearestRow][1][i]) if nearestRow is not None else float('inf'),
+                    edgeDistance(complex(p.imag,p.real), columnPass[nearestColumn][1][j]) if nearestColumn is not None else float('inf')))
+            distance.append(row)
+
+        # near the outline the samples are too sparse, so take the distance to the edges there
+        band = 1.5 * spacing
+        for edges in [polygon] + [occluder for occluder,occluderMode in occluders or ()]:
+            for a,b in edges:
+                d = b - a
+                length2 = d.real * d.real + d.imag * d.imag
+                for j in range(max(0, int((min(a.imag,b.imag) - band - y0) / step)), min(rows, int((max(a.imag,b.imag) + band - y0) / step) + 2)):
+                    y = gridY[j]
+                    # the part of the edge within band of the row
+                    if d.imag == 0:
+                        xMin = min(a.real,b.real)
+                        xMax = max(a.real,b.real)
+                    else:
+                        t1 = min(1., max(0., (y - band - a.imag) / d.imag))
+                        t2 = min(1., max(0., (y + band - a.imag) / d.imag))
+                        xMin = a.real + min(t1,t2) * d.real
+                        xMax = a.real + max(t1,t2) * d.real
+                    row = distance[j]
+                    for i in range(max(0, int((xMin - band - x0) / step)), min(columns, int((xMax + band - x0) / step) + 2)):
+                        p = complex(gridX[i], y)
+                        t = ((p - a) * d.conjugate()).real / length2 if length2 else 0.
+                        t = 0. if t < 0 else (1. if t > 1 else t)
+                        e = abs(p - a - t * d)
+                        if e < row[i]:
+                            row[i] = e
+
+        for j in range(rows):
+            for i in range(columns):
+                if not inside[j][i]:
+                    distance[j][i] = -distance[j][i]
+
+        # marching squares; contour points are keyed by level and grid edge, so that neighboring cells share them
+        points = {}
+        neighbors = {}
+
+        def point(key, z1, v1, z2, v2, level):
+            if key not in points:
+                points[key] = z1 + (z2 - z1) * ((level - v1) / (v2 - v1))
+            return key
+
+        def connect(a, b):
+            neighbors.setdefault(a, []).append(b)
+            neighbors.setdefault(b, []).append(a)
+
+        for j in range(rows - 1):
+            for i in range(columns - 1):
+                # corners counterclockwise from the lower left
+                values = (distance[j][i], distance[j][i+1], distance[j+1][i+1], distance[j+1][i])
+                low = min(values)
+                high = max(values)
+                if high < step:
+                    continue
+                corners = (complex(gridX[i],gridY[j]), complex(gridX[i+1],gridY[j]), complex(gridX[i+1],gridY[j+1]), complex(gridX[i],gridY[j+1]))
+                edgeKeys = (('h',i,j), ('v',i+1,j), ('h',i,j+1), ('v',i,j))
+                for level in range(max(0, int(math.ceil((low - step) / spacing))), int(math.ceil((high - step) / spacing))):
+                    value = step + level * spacing
+                    above = [v > value for v in values]
+                    # edge e runs from corner e to corner e+1
+                    crossed = [e for e in range(4) if above[e] != above[(e+1) % 4]]
+                    keys = dict((e, point((level,) + edgeKeys[e], corners[e], values[e], corners[(e+1) % 4], values[(e+1) % 4], value)) for e in crossed)
+                    if len(crossed) == 2:
+                        connect(keys[crossed[0]], keys[crossed[1]])
+                    else:
+                        # saddle: cut off the corners on the other side from the center
+                        centerAbove = sum(values) / 4. > value
+                        for c in range(4):
+                            if above[c] != centerAbove:
+                                connect(keys[(c+3) % 4], keys[c])
+
+        levels = {}
+        for start in neighbors:
+            if start in points and neighbors[start]:
+                loop = [start]
+                previous = start
+                current = neighbors[start][0]
+                while current != start:
+                    loop.append(current)
+                    following = neighbors[current]
+                    nextKey = following[0] if following[0] != previous else following[1]
+                    previous = current
+                    current = nextKey
+                for key in loop:
+                    neighbors[key] = []
+                loop = Shader._simplify([points[key] for key in loop] + [points[start]], step / 10.)
+                levels.setdefault(start[0], []).append(loop)
+
+        # spirals: go on from the end of each contour to the nearest point of a contour one level in
+        chains = []
+        byLevel = [levels.get(level, []) for level in range(max(levels) + 1)] if levels else []
+        for level in range(len(byLevel)):
+            while byLevel[level]:
+                chain = byLevel[level].pop(0)
+                inner = level + 1
+                while inner < len(byLevel) and byLevel[inner]:
+                    end = chain[-1]
+                    best = None
+                    for n,loop in enumerate(byLevel[inner]):
+                        for k,z in enumerate(loop):
+                            d = abs(z - end)
+                            if best is None or d < best[0]:
+                                best = (d, n, k)
+                    if best[0] > 2 * spacing:
+                        break
+                    loop = byLevel[inner].pop(best[1])
+                    k = best[2]
+                    # the loop is closed, so it can start anywhere
+                    chain += loop[k:-1] + loop[:k+1]
+                    inner += 1
+                chains.append(chain)
+
+        return [(chain[k-1], chain[k]) for chain in chains for k in range(1, len(chain))]
+
+    @staticmethod
+    def _simplify(points, error):
+        """
+        Ramer-Douglas-Peucker: drops points within error of the line between the neighbors that are kept
+        """
+        keep = [False] * len(points)
+        keep[0] = keep[-1] = True
+        stack = [(0, len(points) - 1)]
+        while stack:
+            i,j = stack.pop()
+            a = points[i]
+            d = points[j] - a
+            length = abs(d)
+            worst = error
+            farthest = None
+            for k in range(i+1, j):
+                e = abs(((points[k] - a) * d.conjugate()).imag) / length if length else abs(points[k] - a)
+                if e > worst:
+                    worst = e
+                    farthest = k
+            if farthest is not None:
+                keep[farthest] = True
+                stack.append((i, farthest))
+                stack.append((farthest, j))
+        return [points[k] for k in range(len(points)) if keep[k]]
+
+    @staticmethod
+    def _zigzag(polygon, rows, maxLength):
+        """
+        Chains spans of consecutive scanlines that overlap one to one, that is, that lie in the same
+        monotone part of the polygon, into zig-zags, joining them along the outline where that takes
+        no more than maxLength. Returns a list of lines.
+        """
+        # the lines before and after each line of the outline
+        following = [None] * len(polygon)
+        preceding = [None] * len(polygon)
+        ringStart = 0
+        for i in range(len(polygon)):
+            if i + 1 < len(polygon) and polygon[i+1][0] == polygon[i][1]:
+                j = i + 1
+            else:
+                j = ringStart if polygon[ringStart][0] == polygon[i][1] else None
+                ringStart = i + 1
+            following[i] = j
+            if j is not None:
+                preceding[j] = i
+
+        def connector(a, b):
+            if a[3] is None or b[3] is None:
+                return None
+            if a[3] == b[3]:
+                return [a[0], b[0]]
+            low = min(a[0].imag, b[0].imag)
+            high = max(a[0].imag, b[0].imag)
+            for forward in (True, False):
+                points = [a[0]]
+                length = 0.
+                i = a[3]
+                while True:
+                    vertex = polygon[i][1] if forward else polygon[i][0]
+                    length += abs(vertex - points[-1])
+                    if not low <= vertex.imag <= high or length > maxLength:
+                        break
+                    points.append(vertex)
+                    i = following[i] if forward else preceding[i]
+                    if i is None or i == a[3]:
+                        break
+                    if i == b[3]:
+                        if length + abs(b[0] - vertex) <= maxLength:
+                            points.append(b[0])
+                            return points
+                        break
+            return None
+
+        chains = []
+        previous = []
+
+        for spans in rows:
+            # spans are sorted and disjoint, so overlaps can be found by merging
+            previousCount = [0] * len(previous)
+            count = [0] * len(spans)
+            overlaps = []
+            i = 0
+            j = 0
+            while i < len(previous) and j < len(spans):
+                a = previous[i][1]
+                b = spans[j]
+                if a[0][0].real <= b[1][0].real and b[0][0].real <= a[1][0].real:
+                    overlaps.append((i,j))
+                    previousCount[i] += 1
+                    count[j] += 1
+                if a[1][0].real < b[1][0].real:
+                    i += 1
+                else:
+                    j += 1
+
+            continued = [None] * len(spans)
+            for i,j in overlaps:
+                if previousCount[i] == 1 and count[j] == 1:
+                    continued[j] = previous[i][0]
+
+            current = []
+            for j in range(len(spans)):
+                chain = continued[j]
+                if chain is None:
+                    chain = []
+                    chains.append(chain)
+                chain.append(spans[j])
+                current.append((chain, spans[j]))
+            previous = current
+
+        lines = []
+        for chain in chains:
+            last = None
+            for k in range(len(chain)):
+                span = chain[k] if k % 2 == 0 else (chain[k][1], chain[k][0])
+                if last is not None:
+                    points = connector(last, span[0])
+                    if points is not None:
+                        lines += [(points[i-1], points[i]) for i in range(1, len(points))]
+                lines.append((span[0][0], span[1][0]))
+                last = span[1]
+
+        return lines
+
+    @staticmethod
+    def _pythonCrossings(edges, ys):
+        """Yields the sorted crossings of each scanline, keeping a list of the edges active at it"""
+        nextEdge = 0
+        active = []
+
+        for y in ys:
+            while nextEdge < len(edges) and edges[nextEdge][0] <= y:
+                active.append(edges[nextEdge])
+                nextEdge += 1
+            active = [edge for edge in active if edge[1] > y]
+            xs = []
+            for yMin,yMax,index,line,m,up in active:
+                z = line[0]
+                xs.append(((y-z.imag)/m + z.real if m is not None else z.real, index, up, line))
+            xs.sort(key=itemgetter(0,1))
+            yield [(complex(x, y), up, line, index) for x,index,up,line in xs]
+
+    @staticmethod
+    def _numpyCrossings(edges, ys):
+        """
+        Yields the sorted crossings of each scanline. The scanlines each edge crosses are found by binary search,
+        and then the crossings are computed and sorted together, about NUMPY_CHUNK of them at a time.
+        """
+        yMin = numpy.array([edge[0] for edge in edges])
+        yMax = numpy.array([edge[1] for edge in edges])
+        index = numpy.array([edge[2] for edge in edges])
+        zReal = numpy.array([edge[3][0].real for edge in edges])
+        zImag = numpy.array([edge[3][0].imag for edge in edges])
+        vertical = numpy.array([edge[4] is None for edge in edges])
+        m = numpy.array([1. if edge[4] is None else edge[4] for edge in edges])
+
+        scanY = numpy.array(ys)
+        # edges cross scanlines first to last-1
+        first = numpy.searchsorted(scanY, yMin, 'left')
+        last = numpy.searchsorted(scanY, yMax, 'left')
+        perRow = numpy.cumsum(numpy.bincount(first, minlength=len(ys)+1) - numpy.bincount(last, minlength=len(ys)+1))[:len(ys)]
+        upTo = numpy.cumsum(perRow)
+
+        r0 = 0
+        while r0 < len(ys):
+            done = upTo[r0-1] if r0 else 0
+            r1 = max(r0+1, int(numpy.searchsorted(upTo, done + Shader.NUMPY_CHUNK, 'right')))
+            lo = numpy.clip(first, r0, r1)
+            counts = numpy.clip(last, r0, r1) - lo
+            edge = numpy.repeat(numpy.arange(len(edges)), counts)
+            row = numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts) + numpy.arange(len(edge))
+            x = numpy.where(vertical[edge], zReal[edge], (scanY[row] - zImag[edge]) / m[edge] + zReal[edge])
+            # ties are broken by edge order, as in the python backend
+            order = numpy.lexsort((index[edge], x, row))
+            bounds = numpy.searchsorted(row[order], numpy.arange(r0, r1+1)).tolist()
+            x = x[order].tolist()
+            edge = edge[order].tolist()
+            for r in range(r0, r1):
+                y = ys[r]
+                yield [(complex(x[k], y), edges[edge[k]][5], edges[edge[k]][3], edges[edge[k]][2]) for k in range(bounds[r-r0], bounds[r-r0+1])]
+            r0 = r1
+
+class Outline(object):
+    """
+    The rings of a compound fill outline, built once from its flattened lines.
+
+    Lines that meet end to start, up to snap, are chained into a ring, and rings left open are closed, as SVG
+    closes every subpath it fills; rings whose points all lie on one line cannot change the fill and are dropped
+(a bow-tie, whose halves have areas that cancel, is kept). Otherwise
+    an open subpath, or a gap of a rounding error between two curves, leaves scanlines with an odd number of
+    crossings, which then pair up wrongly and hatch across holes.
+
+    lines holds the edges of all the rings in order, ready for the hatcher.
+    """
+    def __init__(self, lines, snap=None):
+        lines = list(lines)
+        if snap is None:
+            snap = 1e-9 * max([1.] + [max(abs(z.real), abs(z.imag)) for line in lines for z in line])
+
+        chains = []
+        for z0,z1 in lines:
+            if chains and abs(z0 - chains[-1][-1]) <= snap:
+                chains[-1].append(z1)
+            else:
+                chains.append([z0, z1])
+
+        self.rings = []
+        for ring in chains:
+            if abs(ring[-1] - ring[0]) <= snap:
+                ring[-1] = ring[0]
+            else:
+                ring.append(ring[0])
+            if not Outline.flat(ring):
+                self.rings.append(ring)
+
+        self.lines = [(ring[i], ring[i+1]) for ring in self.rings for i in range(len(ring)-1)]
+
+    @staticmethod
+    def flat(ring):
+        """Whether a ring has fewer than three distinct points, or has all its points on one line"""
+        start = ring[0]
+        direction = next((z - start for z in ring if z != start), None)
+        return direction is None or all((direction.conjugate() * (z - start)).imag == 0 for z in ring)
+
 if __name__ == '__main__':
-    polygon=(0+0j, 10+10j, 10+0j, 0+0j)
-    print(shadePolygon(polygon,90,1))
-                    
\ No newline at end of file
+    import sys
+    import time
+
+    # a bow-tie's two halves have areas that cancel, but both are filled; a ring along one line is dropped
+    bowtie = Outline([(10+10j, 50+50j), (50+50j, 50+10j), (50+10j, 10+50j), (10+50j, 10+10j), (0j, 5+5j), (5+5j, 2+2j)])
+    if len(bowtie.rings) != 1 or not Shader.shadePolygon(bowtie.lines, 45, 1.):
+        raise AssertionError("Bow-tie outline lost its fill")
+
+    # benchmark: python -m svgpath.shader [edges]
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    points = [(50 + 20 * math.sin(34 * math.pi * i / n)) * complex(math.cos(2 * math.pi * i / n), math.sin(2 * math.pi * i / n)) for i in range(n)]
+    star = [(points[i-1], points[i]) for i in range(n)]
+    # a comb whose every tooth crosses every scanline
+    points = [complex(100. * (i // 2) / (n // 2), 100. * ((i + 1) // 2 % 2)) for i in range(n)]
+    comb = [(points[i-1], points[i]) for i in range(n)]
+    for name,polygon in (('star', star), ('comb', comb)):
+        for backend in Shader.backends():
+            for spacing in (3., 0.5, 0.1):
+                t0 = time.time()
+                lines = Shader.shadePolygon(polygon, 45, spacing, backend=backend)
+                print("%s %s: %d edges, spacing %g: %d lines in %.3fs" % (name, backend, n, spacing, len(lines), time.time()-t0))
\ No newline at end of file